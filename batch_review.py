@@ -0,0 +1,357 @@
+# Headstone Photograph Processing System
+# Batch Review
+# Reviews a page of images from the feedback queue at once, each shown with the best match found for it
+#
+# Keys:
+#   > Arrows: Move between images
+#   > Y: Confirm the best match of the selected image
+#   > N: Reject it (the image goes back in the queue, to be reviewed on its own)
+#   > Space: Undo the decision on the selected image
+#   > A: Confirm every undecided image on the page that has a match
+#   > Enter: Commit the page and show the next one
+#   > Escape: Return to the Feedback Screen
+#
+# Confirmed images are labeled exactly as if their match were picked on the Feedback Screen
+# Rejected and undecided images go to the back of the queue, as do images confirmed with an entry that's taken by then
+# (or that another image on the page was confirmed with)
+# Labels are applied in a background thread: the fuzziness scores of all the page's entries are set together,
+# then the images are moved and saved and the metadata store committed, while the next page is reviewed
+#
+# Matches stored before the last change to the assignments may no longer be free, so they're scored again in the
+# background, and the image can't be confirmed until they are
+# Images with several perfect matches can't be confirmed here; one of them has to be picked on the Feedback Screen
+
+import copy
+import queue
+import threading
+import traceback
+import tkinter as tk
+
+import cv2
+import PIL
+from PIL import ImageTk
+
+import color_palette
+import global_vars
+import labeling
+import metadata_store
+import thumbnails
+from headstone import Headstone
+
+color = color_palette.color_pallette
+global_vars = global_vars.global_vars
+
+columns = 4
+rows = 3
+page_size = columns * rows
+
+tile_height = 180
+
+decision_colors = {None: color.bg, "Confirm": "#00660C", "Reject": "#6D0000"}
+
+# Pages are committed one at a time, in the order they were reviewed
+commit_lock = threading.Lock()
+commit_threads = list()
+
+
+class Review_Tile(tk.Frame):
+    def __init__(self, master, path):
+        super().__init__(master, bg=color.bg, highlightthickness=3, highlightbackground=color.bg)
+        self.path = path
+        self.headstone = Headstone.load(path)
+        self.decision = None
+        self.entry = None
+        self.confirmable = self.headstone.situation() != "Multiple_Perfect"
+        self.stale = self.headstone.candidates is None or \
+                     self.headstone.candidates_version != labeling.get_assignments_version()
+
+        thumbnail = thumbnails.open_cache().get(self.headstone, "Modified")
+        scale = tile_height / thumbnail.shape[0]
+        thumbnail = cv2.resize(thumbnail, (int(thumbnail.shape[1] * scale), tile_height), interpolation=cv2.INTER_AREA)
+        self.im = ImageTk.PhotoImage(PIL.Image.fromarray(cv2.cvtColor(thumbnail, cv2.COLOR_BGR2RGB)))
+
+        self.img = tk.Label(self, image=self.im, bg=color.bg)
+        self.img.pack()
+
+        self.label = tk.Label(self, text="", bg=color.bg, fg=color.fg, justify="left", wraplength=300)
+        self.label.pack(fill="x")
+
+        if self.stale:
+            self.label.config(text="Checking matches...\n")
+        else:
+            self.set_candidates(self.headstone.candidates, self.headstone.candidates_version)
+
+    # Show the best of the candidates, found at assignments version
+    def set_candidates(self, candidates, version):
+        self.headstone.candidates = candidates
+        self.headstone.candidates_version = version
+        self.stale = False
+        self.entry = None if not candidates else candidates[0]
+        self.label.config(text=self.format_entry())
+
+    def format_entry(self):
+        if self.entry is None:
+            return "No matches found\n"
+        if not self.confirmable:
+            return "Several perfect matches, review on its own\n"
+
+        name = [self.entry.get(k, "") for k in ("First Name", "Middle Name", "Surname")]
+        name = " ".join([str(s) for s in name if s != ""])
+        dates = [str(self.entry.get(k, "")) for k in ("Birth Date", "Death Date")]
+        return name + "\n" + " - ".join(dates) + "    Fuzzy Score: " + str(self.entry["Fuzziness"])
+
+    def decide(self, decision):
+        if decision == "Confirm" and (self.entry is None or self.stale or not self.confirmable):
+            return
+        self.decision = decision
+        for widget in (self.label, self.img):
+            widget.config(bg=decision_colors[decision])
+
+    def select(self, selected):
+        self.config(highlightbackground=color.fg if selected else color.bg)
+
+
+class Batch_Review_Screen(tk.Frame):
+    # Milliseconds between checks for committed pages and matches scored again
+    poll_interval = 200
+
+    def __init__(self, master, feedback_screen):
+        super().__init__(master, bg=color.bg)
+        self.master = master
+        self.feedback_screen = feedback_screen
+
+        self.tiles = list()
+        self.selected = 0
+        self.committed = queue.Queue()
+        self.num_committing = 0
+        self.after_id = None
+
+        # Matches scored again are only shown if they're for the page still shown
+        self.generation = 0
+        self.rescored = queue.Queue()
+        self.num_rescoring = 0
+
+        self.help = tk.Label(self, text="Y confirm, N reject, Space undo, A confirm all, Enter commit page, Escape return",
+                             bg=color.bg, fg=color.fg, padx=10)
+        self.help.pack()
+
+        self.grid_area = tk.Frame(self, bg=color.bg)
+        self.grid_area.pack(fill="both", expand=True)
+
+        self.status = tk.Label(self, text="", bg=color.bg, fg=color.fg, padx=10)
+        self.status.pack(fill="x")
+
+        self.control = tk.Frame(self, bg=color.bg)
+        self.control.pack(fill="x", side="bottom")
+
+        self.return_button = tk.Button(self.control, text="Return", command=self.switch_to_feedback_screen,
+                                       highlightthickness=0, bg=color.accent, fg=color.fg,
+                                       activeforeground=color.bg, activebackground=color.fg)
+
+        self.commit_button = tk.Button(self.control, text="Commit Page", command=self.commit_page,
+                                       highlightthickness=0, bg=color.accent, fg=color.fg,
+                                       activeforeground=color.bg, activebackground=color.fg)
+
+        self.return_button.pack(fill="x", expand=True, side="left")
+        self.commit_button.pack(fill="x", expand=True, side="left")
+
+
+    def show(self):
+        self.pack(fill="both", expand=True)
+        self.master.bind("<Key>", self.key)
+        self.update()
+
+    def switch_to_feedback_screen(self):
+        self.master.unbind("<Key>")
+        self.pack_forget()
+        self.feedback_screen.pack(fill="both", expand=True)
+        self.feedback_screen.update()
+
+
+    # Show the next page of the feedback queue
+    def update(self):
+        for tile in self.tiles:
+            tile.destroy()
+        self.tiles = list()
+        self.selected = 0
+        self.generation += 1
+
+        paths = global_vars.feedback_queue[:page_size]
+        thumbnails.open_cache().prefetch(global_vars.feedback_queue[page_size:2 * page_size])
+
+        for path in paths:
+            try:
+                tile = Review_Tile(self.grid_area, path)
+            except Exception:
+                # Not left at the front of the queue, where every page would show it again
+                traceback.print_exc()
+                try:
+                    global_vars.feedback_queue.remove(path)
+                except ValueError:
+                    pass
+                continue
+            tile.grid(row=len(self.tiles) // columns, column=len(self.tiles) % columns, padx=5, pady=5, sticky="n")
+            self.tiles.append(tile)
+
+        if len(self.tiles) > 0:
+            self.tiles[0].select(True)
+        self.rescore([i for i, tile in enumerate(self.tiles) if tile.stale])
+        self.update_status()
+
+    # Score the matches of the tiles at indexes again, one after another in a background thread
+    def rescore(self, indexes):
+        if len(indexes) == 0:
+            return
+
+        generation = self.generation
+        headstones = list()
+        for i in indexes:
+            headstone = copy.copy(self.tiles[i].headstone)
+            headstone.text_fields = dict(headstone.text_fields)
+            headstones.append((i, headstone))
+
+        def score():
+            for i, headstone in headstones:
+                if generation != self.generation:
+                    break
+                try:
+                    version = labeling.get_assignments_version()
+                    match_df = labeling.feedback_labeling(headstone)
+                    self.rescored.put((generation, i, version, None if match_df is None else match_df.to_dict(orient="records")))
+                except Exception:
+                    traceback.print_exc()
+            self.rescored.put(None)
+
+        threading.Thread(target=score, name="Batch Review Rescore", daemon=True).start()
+        self.num_rescoring += 1
+        self.start_polling()
+
+    def update_status(self):
+        text = "{} images in the queue".format(len(global_vars.feedback_queue))
+        if self.num_committing > 0:
+            text += ", committing {} pages".format(self.num_committing)
+        self.status.config(text=text)
+
+
+    def key(self, event):
+        if event.keysym == "Escape":
+            self.switch_to_feedback_screen()
+        elif event.keysym == "Return":
+            self.commit_page()
+        elif len(self.tiles) == 0:
+            return
+        elif event.keysym in ("Left", "Right", "Up", "Down"):
+            step = {"Left": -1, "Right": 1, "Up": -columns, "Down": columns}[event.keysym]
+            if 0 <= self.selected + step < len(self.tiles):
+                self.tiles[self.selected].select(False)
+                self.selected += step
+                self.tiles[self.selected].select(True)
+        elif event.keysym.lower() == "y":
+            self.tiles[self.selected].decide("Confirm")
+        elif event.keysym.lower() == "n":
+            self.tiles[self.selected].decide("Reject")
+        elif event.keysym == "space":
+            self.tiles[self.selected].decide(None)
+        elif event.keysym.lower() == "a":
+            for tile in self.tiles:
+                if tile.decision is None:
+                    tile.decide("Confirm")
+
+
+    # Take the page's images out of the queue, label the confirmed ones in the background, and show the next page
+    def commit_page(self):
+        # An entry can only be given to one image; if several were confirmed with it, they're all reviewed on their own
+        keys = [entry_key(tile.entry) for tile in self.tiles if tile.decision == "Confirm"]
+        confirmed = [tile for tile in self.tiles if tile.decision == "Confirm" and keys.count(entry_key(tile.entry)) == 1]
+        others = [tile.path for tile in self.tiles if tile not in confirmed]
+
+        # Other threads (the driver, reassignments, the Feedback Folder rescan) append to the queue while this runs
+        # Only the Tk thread takes images out of it, and a single remove() or extend() never loses their appends
+        for tile in self.tiles:
+            try:
+                global_vars.feedback_queue.remove(tile.path)
+            except ValueError:
+                pass
+        global_vars.feedback_queue.extend(others)
+
+        if len(confirmed) > 0:
+            batch = [(tile.path, tile.headstone, tile.entry) for tile in confirmed]
+            thread = threading.Thread(target=commit_batch, args=(batch, self.committed), name="Batch Review Commit")
+            commit_threads.append(thread)
+            thread.start()
+            self.num_committing += 1
+            self.start_polling()
+
+        self.update()
+
+    def start_polling(self):
+        if self.after_id is None:
+            self.after_id = self.after(self.poll_interval, self.poll)
+
+    # Take in committed pages and matches scored again, on the Tk thread
+    def poll(self):
+        self.after_id = None
+
+        while not self.committed.empty():
+            # Put back from the Tk thread, which is the only one that takes images out of the queue (see commit_page)
+            failed = self.committed.get()
+            global_vars.feedback_queue.extend(failed)
+            self.num_committing -= 1
+
+        while not self.rescored.empty():
+            result = self.rescored.get()
+            if result is None:
+                self.num_rescoring -= 1
+                continue
+            generation, i, version, candidates = result
+            if generation == self.generation:
+                self.tiles[i].set_candidates(candidates, version)
+
+        self.update_status()
+
+        if self.num_committing > 0 or self.num_rescoring > 0:
+            self.after_id = self.after(self.poll_interval, self.poll)
+
+
+# Identifies the entry a tile was confirmed with (the fuzziness score isn't part of the entry)
+def entry_key(entry):
+    return tuple([(k, str(v)) for k, v in entry.items() if k != "Fuzziness"])
+
+
+# Label every headstone in batch with its entry, as Feedback_Screen.label_headstone does for one
+# Puts the paths of the headstones that weren't labeled in done, to go back in the feedback queue
+def commit_batch(batch, done):
+    with commit_lock:
+        failed = list()
+        try:
+            assigned = labeling.set_fuzziness_batch([entry for path, headstone, entry in batch], 100)
+        except Exception:
+            traceback.print_exc()
+            done.put([path for path, headstone, entry in batch])
+            return
+
+        for (path, headstone, entry), is_assigned in zip(batch, assigned):
+            # Taken by another image since the matches were found
+            if not is_assigned:
+                failed.append(path)
+                continue
+
+            try:
+                headstone.fuzziness_score = 100
+                headstone.set_label(global_vars.options["Label Format"].format(entry))
+                headstone.error = None
+                headstone.log_event("Manually labeled with label '{}' in batch review".format(headstone.label), stage="Feedback")
+                headstone.move("Destination Folder", target="MODIFIED", apply_label=True)
+                headstone.save()
+            except Exception:
+                traceback.print_exc()
+                failed.append(path)
+
+        metadata_store.commit()
+        done.put(failed)
+
+
+# Wait until every committed page is labeled
+def wait():
+    for thread in list(commit_threads):
+        thread.join()
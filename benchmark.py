@@ -0,0 +1,414 @@
+# Headstone Photograph Processing System
+# Benchmark Suite
+# Generates synthetic headstone photographs (rendered inscriptions with known names and dates, random rotation
+# and background clutter) with a matching synthetic data file, then times each stage of the pipeline
+# in isolation and end-to-end
+#
+# Results are written as JSON so that runs can be compared across versions:
+#   python benchmark.py run --images 50 --rows 5000 --output results.json
+#   python benchmark.py compare old_results.json new_results.json
+#
+# Stages whose models or libraries are not available are reported as skipped, with the reason
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import cv2
+import numpy as np
+import pandas as pd
+
+import metrics
+
+first_names = ("JAMES", "JOHN", "ROBERT", "MICHAEL", "WILLIAM", "DAVID", "RICHARD", "JOSEPH", "THOMAS", "CHARLES",
+               "CHRISTOPHER", "DANIEL", "MATTHEW", "ANTHONY", "DONALD", "MARK", "PAUL", "STEVEN", "ANDREW", "KENNETH",
+               "GEORGE", "EDWARD", "RONALD", "TIMOTHY", "JASON", "JEFFREY", "FRANK", "GARY", "RAYMOND", "HAROLD",
+               "CARL", "ARTHUR", "EDMUND", "WALTER", "HENRY", "RALPH", "ROY", "LOUIS", "EUGENE", "HOWARD",
+               "MARY", "PATRICIA", "JENNIFER", "LINDA", "ELIZABETH", "BARBARA", "SUSAN", "MARGARET", "DOROTHY", "HELEN")
+
+surnames = ("SMITH", "JOHNSON", "WILLIAMS", "BROWN", "JONES", "GARCIA", "MILLER", "DAVIS", "RODRIGUEZ", "MARTINEZ",
+            "HERNANDEZ", "LOPEZ", "GONZALEZ", "WILSON", "ANDERSON", "THOMAS", "TAYLOR", "MOORE", "JACKSON", "MARTIN",
+            "LEE", "PEREZ", "THOMPSON", "WHITE", "HARRIS", "SANCHEZ", "CLARK", "RAMIREZ", "LEWIS", "ROBINSON",
+            "WALKER", "YOUNG", "ALLEN", "KING", "WRIGHT", "SCOTT", "TORRES", "NGUYEN", "HILL", "FLORES",
+            "GREEN", "ADAMS", "NELSON", "BAKER", "HALL", "RIVERA", "CAMPBELL", "MITCHELL", "CARTER", "ROBERTS",
+            "MATHEWS", "STINNETT", "OSBORNE", "WHITAKER", "FLETCHER", "HOLLOWAY", "PRESCOTT", "CALLAHAN", "DUNCAN", "BURKE")
+
+states = ("ALABAMA", "ARKANSAS", "CALIFORNIA", "FLORIDA", "GEORGIA", "ILLINOIS", "INDIANA", "KENTUCKY", "MARYLAND",
+          "MICHIGAN", "MISSOURI", "NEW YORK", "NORTH CAROLINA", "OHIO", "OKLAHOMA", "PENNSYLVANIA", "TENNESSEE",
+          "TEXAS", "VERMONT", "VIRGINIA")
+
+# (conflict as written in the data file, conflict as inscribed on the headstone)
+conflicts = (("WWI", "WORLD WAR I"), ("WWII", "WORLD WAR II"), ("KOREA", "KOREA"), ("VIETNAM", "VIETNAM"))
+
+ranks = ("PVT US ARMY", "PFC US ARMY", "SGT US ARMY", "S SGT US ARMY", "SEAMAN 2CL US NAVY", "CPL USMC", "TSGT US AIR FORCE")
+
+month_names = ("JANUARY", "FEBRUARY", "MARCH", "APRIL", "MAY", "JUNE", "JULY",
+               "AUGUST", "SEPTEMBER", "OCTOBER", "NOVEMBER", "DECEMBER")
+
+# Data files in the wild use all sorts of date formats
+date_formats = ("{m}/{d}/{y}", "{y}-{m:02}-{d:02}", "{month} {d} {y}", "{d} {month} {y}")
+
+# Characters OCR commonly confuses with each other
+ocr_confusions = {'O': '0', '0': 'O', 'I': '1', '1': 'I', 'S': '5', '5': 'S', 'B': '8', '8': 'B', 'E': 'F', 'G': 'C', 'U': 'V'}
+
+
+# Generate num_rows random gravesite entries, in the format of the Data File
+def generate_entries(num_rows, seed=0):
+    rng = random.Random(seed)
+    entries = list()
+
+    for i in range(num_rows):
+        birth_year = rng.randint(1850, 1960)
+        death_year = min(birth_year + rng.randint(18, 95), 2020)
+        conflict = rng.choice(conflicts)
+        birth = (birth_year, rng.randint(1, 12), rng.randint(1, 28))
+        death = (death_year, rng.randint(1, 12), rng.randint(1, 28))
+
+        entries.append({
+            "First Name": rng.choice(first_names),
+            "Middle Name": rng.choice(first_names) if rng.random() < 0.6 else "",
+            "Surname": rng.choice(surnames),
+            "State": rng.choice(states),
+            "Conflict": conflict[0],
+            "Birth Date": format_date(birth, rng.choice(date_formats)),
+            "Death Date": format_date(death, rng.choice(date_formats)),
+            "Section": rng.randint(1, 60),
+            "Row": rng.randint(1, 40),
+            "Site": i + 1
+        })
+
+    return entries
+
+
+def format_date(date, date_format):
+    y, m, d = date
+    return date_format.format(y=y, m=m, d=d, month=month_names[m - 1])
+
+
+# Write entries to path as a csv Data File
+def write_data_file(path, entries):
+    pd.DataFrame(entries).to_csv(path, index=False)
+
+
+# The lines inscribed on the headstone of a data file entry, top to bottom
+def inscription(entry, rng):
+    conflict = dict(conflicts)[entry["Conflict"]]
+    lines = [entry["First Name"]]
+    if entry["Middle Name"] != "":
+        lines.append(entry["Middle Name"])
+    lines += [entry["Surname"], entry["State"], rng.choice(ranks), conflict]
+
+    for column in ("Birth Date", "Death Date"):
+        y, m, d = parse_date(entry[column])
+        lines.append("{} {} {}".format(month_names[m - 1], d, y))
+
+    return lines
+
+
+# Inverse of format_date for the formats in date_formats
+def parse_date(s):
+    parts = s.replace('/', ' ').replace('-', ' ').split()
+    if '/' in s:
+        m, d, y = parts
+    elif '-' in s:
+        y, m, d = parts
+    elif parts[0].isdigit():
+        d, m, y = parts
+    else:
+        m, d, y = parts
+
+    if not m.isdigit():
+        m = month_names.index(m) + 1
+
+    return int(y), int(m), int(d)
+
+
+# Simulate OCR errors by replacing characters with commonly confused ones
+def add_ocr_noise(lines, rng, error_rate=0.05):
+    noisy = list()
+    for line in lines:
+        chars = [ocr_confusions.get(c, c) if rng.random() < error_rate else c for c in line]
+        noisy.append(''.join(chars))
+    return noisy
+
+
+# Render a photograph of a headstone with the given inscription
+# Returns the image (BGR) and the macro/micro rotation applied to it
+def render_headstone(lines, rng, width=1600, height=1200):
+    np_rng = np.random.default_rng(rng.randint(0, 2**32 - 1))
+
+    # Grass and clutter in the background
+    image = np.empty((height, width, 3), np.uint8)
+    image[:] = (40 + rng.randint(0, 30), 110 + rng.randint(0, 40), 50 + rng.randint(0, 30))
+    image = cv2.add(image, np_rng.integers(0, 40, image.shape, dtype=np.uint8))
+    for _ in range(rng.randint(5, 20)):
+        center = (rng.randint(0, width), rng.randint(0, height))
+        color = tuple(rng.randint(0, 255) for _ in range(3))
+        cv2.circle(image, center, rng.randint(5, 60), color, -1)
+
+    # The stone: a light rectangle with a rounded top
+    stone_w = int(width * rng.uniform(0.35, 0.5))
+    stone_h = int(height * rng.uniform(0.7, 0.85))
+    left = (width - stone_w) // 2 + rng.randint(-width // 10, width // 10)
+    top = height - stone_h - rng.randint(0, height // 20)
+    shade = rng.randint(190, 235)
+    cv2.rectangle(image, (left, top + stone_w // 4), (left + stone_w, top + stone_h), (shade, shade, shade), -1)
+    cv2.ellipse(image, (left + stone_w // 2, top + stone_w // 4), (stone_w // 2, stone_w // 4), 0, 180, 360, (shade, shade, shade), -1)
+
+    # The inscription, centered on the stone
+    scale = stone_w / 600
+    line_height = int(stone_h / (len(lines) + 3))
+    y = top + stone_w // 4 + line_height
+    for line in lines:
+        (text_w, _), _ = cv2.getTextSize(line, cv2.FONT_HERSHEY_DUPLEX, scale, 2)
+        x = left + (stone_w - text_w) // 2
+        cv2.putText(image, line, (x, y), cv2.FONT_HERSHEY_DUPLEX, scale, (60, 60, 60), max(int(2 * scale), 1), cv2.LINE_AA)
+        y += line_height
+
+    # Photographed slightly askew, and sometimes sideways or upside down
+    micro = rng.uniform(-5, 5)
+    rot_mat = cv2.getRotationMatrix2D((width / 2, height / 2), micro, 1.0)
+    image = cv2.warpAffine(image, rot_mat, (width, height), borderMode=cv2.BORDER_REFLECT)
+
+    macro = rng.choice((None, None, None, None, None, cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE))
+    if macro is not None:
+        image = cv2.rotate(image, macro)
+
+    return image, macro, micro
+
+
+# Write num_images synthetic photos into image_folder, and a data file of num_rows entries to data_file
+# The photographed headstones are the first num_images entries of the data file
+# Returns a list of fixtures: dicts with the image's path, its inscription, noisy OCR lines and the rotation applied
+def generate_fixtures(image_folder, data_file, num_images, num_rows, seed=0, width=1600, height=1200):
+    rng = random.Random(seed)
+    entries = generate_entries(max(num_rows, num_images), seed)
+    write_data_file(data_file, entries)
+
+    fixtures = list()
+    for i, entry in enumerate(entries[:num_images]):
+        lines = inscription(entry, rng)
+        image, macro, micro = render_headstone(lines, rng, width, height)
+        path = os.path.join(image_folder, "IMG_{:05}.JPG".format(i))
+        cv2.imwrite(path, image)
+        fixtures.append({
+            "Path": path,
+            "Entry": entry,
+            "Lines": lines,
+            "OCR Lines": add_ocr_noise(lines, rng),
+            "Macro": macro,
+            "Micro": micro
+        })
+
+    return fixtures
+
+
+# Call func once per input, returning a summary of the call times
+def time_calls(func, inputs):
+    times = list()
+    for x in inputs:
+        start = time.perf_counter()
+        func(x)
+        times.append(time.perf_counter() - start)
+    return metrics.summarize(times)
+
+
+# Run one stage benchmark, reporting it as skipped if its dependencies can't be loaded
+def run_stage(name, bench):
+    try:
+        return bench()
+    except (ImportError, OSError) as e:
+        return {"Skipped": "{}: {}".format(type(e).__name__, e)}
+    except Exception as e:
+        traceback.print_exc()
+        return {"Failed": "{}: {}".format(type(e).__name__, e)}
+
+
+# Point the global settings at a working folder containing the fixtures
+def configure_working_folder(working_folder):
+    from global_vars import global_vars, default_settings
+    global_vars.parameters["Working Folder"] = working_folder
+    for parameter in ("Image Folder", "Data File", "Destination Folder", "Error Folder",
+                      "Feedback Folder", "Processed Originals Folder", "Log File"):
+        global_vars.parameters[parameter] = "{}" + os.sep + default_settings[parameter]
+    global_vars.init_working_folder()
+
+    # As converted by the Initialization_Screen from the user's "{Section}-{Site}"
+    global_vars.options["Label Format"] = "{0[Section]}-{0[Site]}"
+    return global_vars
+
+
+def bench_rotation(fixtures):
+    from rotation import rotation_algorithm
+    images = [cv2.imread(f["Path"]) for f in fixtures]
+    rotation_algorithm(images[0], True, True)  # Model loading is not part of the measurement
+    return time_calls(lambda image: rotation_algorithm(image, True, True), images)
+
+
+def bench_cropping(fixtures):
+    from cropping import cropping_process
+    images = [cv2.imread(f["Path"]) for f in fixtures]
+    cropping_process(images[0], 0)
+    return time_calls(lambda image: cropping_process(image, 0), images)
+
+
+def bench_ocr(fixtures):
+    from mainOCR import OCR
+    images = [cv2.imread(f["Path"]) for f in fixtures]
+    return time_calls(lambda image: OCR(image, False), images)
+
+
+def make_headstones(fixtures, noisy=True):
+    from headstone import Headstone
+    headstones = list()
+    for f in fixtures:
+        headstone = Headstone(f["Path"])
+        headstone.ocr_text = list(f["OCR Lines"] if noisy else f["Lines"])
+        headstones.append(headstone)
+    return headstones
+
+
+def bench_categorize(fixtures):
+    from categorize_ocr_output import categorize_ocr_output
+    return time_calls(categorize_ocr_output, make_headstones(fixtures))
+
+
+def bench_labeling(fixtures):
+    import labeling
+    from categorize_ocr_output import categorize_ocr_output
+    labeling.df = None
+    labeling.dicts_df = None
+    labeling.load_data()
+
+    headstones = make_headstones(fixtures)
+    for headstone in headstones:
+        categorize_ocr_output(headstone)
+    return time_calls(labeling.get_fuzzy_matches, headstones)
+
+
+# Run the driver's whole per-image pipeline on every fixture, using the stage timers in metrics
+def bench_end_to_end(fixtures):
+    import driver
+    import labeling
+    labeling.df = None
+    labeling.dicts_df = None
+    labeling.load_data()
+
+    selected = list()
+    for f in fixtures:
+        metrics.begin_image(os.path.basename(f["Path"]))
+        driver.process_image(f["Path"])
+        selected.append(metrics.end_image())
+
+    return metrics.summary(selected)
+
+
+# Current version of the code, so results from different versions can be told apart
+def code_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return ""
+
+
+def run(args):
+    results = {
+        "Version": code_version(),
+        "Python": sys.version.split()[0],
+        "Platform": platform.platform(),
+        "Config": vars(args).copy(),
+        "Stages": dict()
+    }
+    del results["Config"]["func"]
+
+    with tempfile.TemporaryDirectory() as working_folder:
+        global_vars = configure_working_folder(working_folder)
+
+        start = time.perf_counter()
+        fixtures = generate_fixtures(global_vars.parameters["Image Folder"], global_vars.parameters["Data File"],
+                                     args.images, args.rows, args.seed, args.width, args.height)
+        results["Fixture Generation"] = time.perf_counter() - start
+
+        stages = [
+            ("rotation_algorithm", bench_rotation),
+            ("cropping_process", bench_cropping),
+            ("mainOCR.OCR", bench_ocr),
+            ("categorize_ocr_output", bench_categorize),
+            ("labeling.get_fuzzy_matches", bench_labeling),
+        ]
+        for name, bench in stages:
+            if args.stages is None or name in args.stages:
+                print("Benchmarking", name, file=sys.stderr)
+                results["Stages"][name] = run_stage(name, lambda: bench(fixtures))
+
+        if not args.skip_end_to_end:
+            print("Benchmarking end-to-end", file=sys.stderr)
+            results["End To End"] = run_stage("End To End", lambda: bench_end_to_end(fixtures))
+
+    output = json.dumps(results, indent=4, default=str)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+# Print every stage whose p50 got slower by more than tolerance (a fraction) between two result files
+# Exits with status 1 if any did
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    regressions = list()
+    for name, new_result in new["Stages"].items():
+        old_result = old["Stages"].get(name, dict())
+        if "p50" not in new_result or "p50" not in old_result or old_result["p50"] == 0:
+            continue
+
+        change = new_result["p50"] / old_result["p50"] - 1
+        print("{:<30}{:>12.4f}{:>12.4f}{:>+10.1%}".format(name, old_result["p50"], new_result["p50"], change))
+        if change > args.tolerance:
+            regressions.append(name)
+
+    if len(regressions) > 0:
+        print("Regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the headstone processing pipeline on synthetic photos")
+    subparsers = parser.add_subparsers(required=True)
+
+    run_parser = subparsers.add_parser("run", help="generate fixtures and time each stage")
+    run_parser.add_argument("--images", type=int, default=20, help="number of synthetic photos")
+    run_parser.add_argument("--rows", type=int, default=1000, help="number of rows in the synthetic data file")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--width", type=int, default=1600, help="width of the synthetic photos")
+    run_parser.add_argument("--height", type=int, default=1200, help="height of the synthetic photos")
+    run_parser.add_argument("--stages", nargs="*", help="only run these stages (default: all)")
+    run_parser.add_argument("--skip-end-to-end", action="store_true")
+    run_parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown before flagging, as a fraction")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
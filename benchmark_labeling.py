@@ -0,0 +1,134 @@
+# Headstone Photograph Processing System
+# Labeling Scalability Benchmark
+# Measures how labeling scales with the size of the data file
+#
+# For each data file size, a synthetic data file is generated (see benchmark.py) and loaded through labeling.load_data,
+# then the same set of OCR-derived headstones is labeled with labeling.driver_labeling
+# Reports the load time, the memory used by df and dicts_df, and the latency per label, as JSON:
+#   python benchmark_labeling.py --sizes 1000 10000 100000 1000000 --labels 10 --output labeling_results.json
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import benchmark
+import metrics
+
+
+# Approximate memory held by an object and everything it references, counting shared objects once
+def deep_size(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(x, seen) for x in obj)
+    return size
+
+
+# Headstones as they come out of OCR and categorization, for the first num_labels entries of the data file
+# The entries (and therefore the headstones) are the same for every data file size
+def make_headstones(num_labels, seed):
+    from headstone import Headstone
+    from categorize_ocr_output import categorize_ocr_output
+
+    rng = random.Random(seed)
+    headstones = list()
+    for i, entry in enumerate(benchmark.generate_entries(num_labels, seed)):
+        headstone = Headstone("IMG_{:05}.JPG".format(i))
+        headstone.ocr_text = benchmark.add_ocr_noise(benchmark.inscription(entry, rng), rng)
+        categorize_ocr_output(headstone)
+        headstones.append(headstone)
+    return headstones
+
+
+def bench_size(num_rows, headstones, working_folder, seed):
+    import labeling
+    import exceptions
+    from global_vars import global_vars
+
+    data_file = os.path.join(working_folder, "data_{}.csv".format(num_rows))
+    benchmark.write_data_file(data_file, benchmark.generate_entries(num_rows, seed))
+    global_vars.parameters["Data File"] = data_file
+
+    labeling.df = None
+    labeling.dicts_df = None
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    labeling.load_data()
+    load_time = time.perf_counter() - start
+    _, load_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "Rows": num_rows,
+        "Load Time": load_time,
+        "Load Peak Memory": load_peak,
+        "df Memory": int(labeling.df.memory_usage(deep=True).sum()),
+        "dicts_df Memory": deep_size(labeling.dicts_df),
+        "Situations": dict()
+    }
+
+    times = list()
+    for headstone in headstones:
+        # Every label starts from a fresh data file, so no reassignments are triggered
+        labeling.df['Fuzziness'] = 0.0
+        headstone.label = None
+
+        start = time.perf_counter()
+        try:
+            labeling.driver_labeling(headstone)
+            situation = "Labeled"
+        except exceptions.LabelError as e:
+            situation = e.situation.name
+        times.append(time.perf_counter() - start)
+
+        result["Situations"][situation] = result["Situations"].get(situation, 0) + 1
+
+    result["Label Latency"] = metrics.summarize(times)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark labeling against data files of increasing size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], help="data file sizes (rows)")
+    parser.add_argument("--labels", type=int, default=10, help="number of headstones labeled per data file size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    results = {
+        "Version": benchmark.code_version(),
+        "Config": vars(args),
+        "Sizes": list()
+    }
+
+    with tempfile.TemporaryDirectory() as working_folder:
+        benchmark.configure_working_folder(working_folder)
+        headstones = make_headstones(args.labels, args.seed)
+
+        for num_rows in args.sizes:
+            print("Benchmarking labeling with {} rows".format(num_rows), file=sys.stderr)
+            results["Sizes"].append(bench_size(num_rows, headstones, working_folder, args.seed))
+
+    output = json.dumps(results, indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from fuzzywuzzy import process, fuzz
+from fuzzywuzzy import fuzz, utils
+from functools import lru_cache
 import date_to_iso
 import traceback
 
@@ -21,6 +22,37 @@ conflicts = set(conflicts)
 months = set(date_to_iso.months.keys())
 
 
+# Finds the best match for a piece of text among a fixed set of options
+# Gives the same result as process.extract(text, options, limit=1, scorer=fuzz.ratio)[0], but:
+#   - the options are processed once, when the matcher is made
+#   - options too different in length to beat the best score so far are skipped (fuzz.ratio can't exceed 2*shorter/total)
+#   - results are remembered for every distinct text
+# Options are tried in the same order as process.extract iterates them, so ties are broken the same way
+class Matcher:
+    def __init__(self, options, cache_size=4096):
+        self.options = [(option, utils.full_process(option)) for option in options]
+        self.best = lru_cache(maxsize=cache_size)(self.find_best)
+
+    def find_best(self, text):
+        query = utils.full_process(text)
+        best = None
+
+        for option, processed in self.options:
+            if best is not None and len(query) > 0:
+                bound = utils.intr(100 * (2.0 * min(len(query), len(processed)) / (len(query) + len(processed))))
+                if bound <= best[1]:
+                    continue
+
+            score = fuzz.ratio(query, processed)
+            if best is None or score > best[1]:
+                best = (option, score)
+
+        return best
+
+
+matchers = {"state": Matcher(states), "conflict": Matcher(conflicts)}
+
+
 debug = False
 
 # Input: a headstone with ocr output stored in headstone.ocr_text
@@ -94,15 +126,11 @@ def remove_dummy_characters(ocr_text):
 def classify(ocr_text, category):
     category = category.lower()
 
-    if category == "state":
-        options = states
-    elif category == "conflict":
-        options = conflicts
-    else:
+    if category not in matchers:
         raise ValueError("category must be 'state' or 'conflict'")
 
     # For each text element find the option with highest score
-    selection_with_score = [process.extract(element.upper(), options, limit=1, scorer=fuzz.ratio)[0] + (i,) for i, element in enumerate(ocr_text)]
+    selection_with_score = [matchers[category].best(element.upper()) + (i,) for i, element in enumerate(ocr_text)]
     
     # Find the best option overall
     if debug:
@@ -154,17 +182,18 @@ def find_dates(ocr_text):
 def date_score(text):
     miniscores = []
     for part in text.split():
-        part_scores = [(month, fuzz.ratio(part, month)) for month in months]
-        part_scores.sort(key=lambda x: x[1], reverse=True)
-        miniscores.append(part_scores[0])
+        miniscores.append(month_score(part))
 
         if set(part) <= date_to_iso.digits and 1700 <= int(part) <= 2100:
             return 100
 
-    miniscores.sort(key=lambda x: x[1], reverse=True)
-    month, score = miniscores[0]
+    return max(miniscores)
+
 
-    return score
+# Score of the month closest to part, remembered for every distinct part
+@lru_cache(maxsize=4096)
+def month_score(part):
+    return max([fuzz.ratio(part, month) for month in months])
 
 
 
@@ -1,5 +1,7 @@
 from fuzzywuzzy import process
+from functools import lru_cache
 import enum
+import re
 
 months = {"JANUARY":1,
           "FEBRUARY":2,
@@ -20,6 +22,12 @@ letters = set(letters + letters.upper())
 digits = set('1234567890')
 valid = letters ^ digits
 
+# Runs of valid characters; anything else separates the parts of a date
+part_pattern = re.compile(r'[A-Za-z0-9]+')
+
+# Most distinct dates and month names remembered
+cache_size = 8192
+
 class Part(enum.Enum):
         year = 0
         month = 1
@@ -28,6 +36,7 @@ class Part(enum.Enum):
         month_or_year = 4
         unknown = 5
 
+@lru_cache(maxsize=cache_size)
 def month_name_to_number(month):
     # Check if the month is already a number
     try:
@@ -107,56 +116,82 @@ def date_to_iso(date):
     if check_iso(date):
         return date
 
-    # Extract bad characters
-    # Replace all bad characters with dashes
-    date = ''.join([c if c in valid else "-" for c in date])
-    # Split on the dashes
-    date = date.split("-")
-    # Remove empty strings
-    date = [s for s in date if s != '']
+    # Split on everything that isn't a letter or digit
+    # Dates that only differ in separators ("JUNE 2 1956", "JUNE 2, 1956") share a cache entry
+    return parts_to_iso(tuple(part_pattern.findall(date)))
+
 
-    # Pain
-    parts = [classify_part(part) for part in date]
+# Convert the parts of a date to ISO, remembering the result for every distinct date
+@lru_cache(maxsize=cache_size)
+def parts_to_iso(date):
     year = ''
     month = ''
     day = ''
 
-    #print(parts, date)
+    # Parts that are certain are assigned as they're classified (the first of each kind wins)
+    # Ambiguous and unknown parts are kept, in order, to fill what's left afterwards
+    ambiguous = []
+    unknown = []
 
-    for part, s in zip(parts, date):
-        if part == Part.year and year == '':
-            year = s
-        elif part == Part.day and day == '':
-            day = s
-        elif part == Part.month and month == '':
-            month += s
+    for s in date:
+        part = classify_part(s)
+        if part == Part.year:
+            if year == '':
+                year = s
+        elif part == Part.day:
+            if day == '':
+                day = s
+        elif part == Part.month:
+            if month == '':
+                month = s
+        elif part == Part.unknown:
+            unknown.append(s)
+        else:
+            ambiguous.append((part, s))
 
-    for part, s in zip(parts, date):
+    for part, s in ambiguous:
         if part == Part.month_or_day:
             if month != '' or day == '':
                 day = s
             else:
                 month += s
-        if part == Part.month_or_year:
+        else:
             if month != '' or year == '':
                 year = s
             else:
                 month += s
-    
-    for part, s in zip(parts, date):
-        if part == Part.unknown:
-            if year == '':
-                year = s
-            elif month == '':
-                month = s
-            elif day == '':
-                day = s
+
+    for s in unknown:
+        if year == '':
+            year = s
+        elif month == '':
+            month = s
+        elif day == '':
+            day = s
 
     if month != '':
         month = month_name_to_number(month)
     return create_iso(year, month, day)
 
 
+# Convert a whole column of dates at once, converting each distinct date only once
+# Missing values (None, NaN or empty) become ''
+def dates_to_iso(dates):
+    converted = dict()
+    output = []
+    for date in dates:
+        if date is None or date != date or date == '':
+            output.append('')
+            continue
+
+        date = str(date)
+        if date not in converted:
+            converted[date] = date_to_iso(date)
+        output.append(converted[date])
+
+    return output
+
+
 
 
 if __name__ == "__main__":
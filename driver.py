@@ -3,38 +3,38 @@ from processing import Processing_Screen
 from headstone import Headstone
 from categorize_ocr_output import categorize_ocr_output
 import labeling
+import result_cache
 from global_vars import global_vars, slash
 import exceptions
+import metrics
+import metrics_exporter
+import metadata_store
+import image_writer
+import thumbnails
+import batch_review
+import profiling
+import watcher
 import threading
-import time
+import json
 import tkinter as tk
 import glob
-import numpy as np
-from PIL import Image
-import cv2
 import traceback
 
 data_loaded = False
 
 debug = False
-timing = False
-timing_ouput_file = "runtime_output_file.txt"
-profiling = False
-profiling_output_file = "profiling_output_file.prof"
+timing_output_file = "runtime_output_file.jsonl"
+timing_summary_file = "runtime_summary.json"
 
 if global_vars.toggles["Macro Rotate"] or global_vars.toggles["Micro Rotate"]:
-    from rotation import rotation_algorithm as rotate
+    from rotation import find_rotation, apply_rotation, rotation_matrix, rotate_and_crop, prefilter
 
 if global_vars.toggles["Crop"]:
-    from cropping import cropping_process as crop
+    from cropping import find_crop_box
 
 if global_vars.toggles["OCR"]:
     from mainOCR import OCR
 
-if profiling:
-    import cProfile
-    import pstats
-
 
 def drive(main_window):
     initialize(main_window)
@@ -46,15 +46,7 @@ def drive(main_window):
     global data_loaded
     data_loaded = True
     
-    if profiling:
-        with cProfile.Profile() as pr:
-            process_images(main_window, image_paths)
-        
-        stats = pstats.Stats(pr)
-        stats.sort_stats(pstats.SortKey.TIME)
-        stats.dump_stats(filename=profiling_output_file)
-    else:
-        process_images(main_window, image_paths)
+    process_images(main_window, image_paths)
 
 
 def initialize(main_window):
@@ -76,31 +68,53 @@ def load_images():
 def process_images(main_window, image_paths):
     screen = Processing_Screen(main_window)
 
+    metrics.register_gauge("Feedback", lambda: len(global_vars.feedback_queue))
+    image_writer.open_writer()
+
+    if global_vars.performance["Metrics Port"] > 0:
+        metrics_exporter.start(global_vars.performance["Metrics Port"])
+
+    profiling.start(global_vars.performance)
+
+    # Per-image stage timings are always recorded, but only written out if requested
+    timing = global_vars.performance["Stage Timing"]
+    if timing:
+        metrics.output_file = timing_output_file
+
+    # Photos added to the Image Folder are processed as they arrive, until aborted
+    if global_vars.performance["Watch Folder"]:
+        image_paths = watcher.stream(image_paths, screen.is_aborting)
+
     for i, path in enumerate(image_paths):
         global_vars.current_image = i + 1
 
-        if screen.update():
+        if screen.is_aborting():
             break
 
         if debug: 
             print("Processing Image {}: {}".format(i+1, Headstone.extract_filename(path)))
         
-        if timing:
-            start = time.perf_counter()
-
+        metrics.begin_image(Headstone.extract_filename(path)[1:])
         process_image(path)
-
-        if timing or debug:
-            end = time.perf_counter()
-            elapsed = end - start
+        record = metrics.end_image()
         
         if debug:
-            print(f"Image {i+1} processed in {elapsed:.02f} seconds")
+            print(f"Image {i+1} processed in {record['Total']:.02f} seconds")
+
+    profiling.finish()
+    image_writer.wait_all()
+    metadata_store.commit()
+
+    if global_vars.performance["Orientation Prefilter"] and global_vars.toggles["Macro Rotate"]:
+        print(prefilter.report())
 
-        if timing:
-            with open(timing_ouput_file, 'a') as f:
-                f.write(f"{elapsed:.02f}\n")
+    if timing or debug:
+        summary = metrics.summary()
+        print(metrics.format_summary(summary))
 
+    if timing:
+        with open(timing_summary_file, 'w') as f:
+            json.dump(summary, f, indent=4)
 
     screen.done()
 
@@ -109,8 +123,20 @@ def process_image(path):
     headstone = Headstone(path)
 
     try:
-        modify_image(headstone)
-    except Exception:
+        cached = None
+        if global_vars.performance["Result Cache"]:
+            cached = result_cache.lookup(headstone)
+            if cached is not None:
+                metrics.count("Cache Hits")
+
+        if cached is None:
+            modify_image(headstone)
+            if not global_vars.toggles["OCR"] and global_vars.performance["Result Cache"]:
+                result_cache.store(headstone)
+        else:
+            restore_image(headstone, cached)
+    except Exception as e:
+        metrics.record_error(e)
         headstone.move("Error Folder")
         headstone.save()
         traceback.print_exc()
@@ -121,17 +147,21 @@ def process_image(path):
 
     try:
         label_image(headstone)
-    except exceptions.OCRError:
-        pass
+    except exceptions.OCRError as e:
+        metrics.record_error(e)
     except exceptions.LabelError as e:
+        metrics.record_error(e)
         headstone.write_modified("Feedback Folder")
         headstone.save()
-        if global_vars.options["User Feedback"] == "Full" or \
-        e.situation in (exceptions.LabelError.Situations.Multiple_Perfect, exceptions.LabelError.Situations.Debugging) or \
-        e.situation in (exceptions.LabelError.Situations.Fuzzy, exceptions.LabelError.Situations.Fuzzy_Tie, exceptions.LabelError.Situations.Too_Close_To_Call) and global_vars.options["User Feedback"] != "Reject":
+        if labeling.wants_feedback(e.situation.name):
+            try:
+                thumbnails.open_cache().add(headstone)
+            except Exception:
+                traceback.print_exc()
             global_vars.feedback_queue.append(headstone.modified_path)
         return
-    except Exception:
+    except Exception as e:
+        metrics.record_error(e)
         headstone.move("Error Folder")
         headstone.save()
         return
@@ -141,64 +171,127 @@ def process_image(path):
 
 
 def modify_image(headstone): 
+    # The proxy is read first, so it's decoded reduced straight from the file
+    # The full image is only decoded where the final rotation or the crop needs it
+    proxy = headstone.proxy_image
+    image = None
+
+    fused = is_fused()
+
     if global_vars.toggles["Micro Rotate"] or global_vars.toggles["Macro Rotate"]:
         try:
-            headstone.modified_image = rotate(headstone.original_image, global_vars.toggles["Macro Rotate"], global_vars.toggles["Micro Rotate"])
+            # Angles are found on the reduced proxy, only the final rotation touches the full image
+            prefilter_key = None
+            if global_vars.performance["Orientation Prefilter"]:
+                prefilter_key = prefilter.key(headstone.original_path, proxy)
+            headstone.rotation = find_rotation(proxy, global_vars.toggles["Macro Rotate"], global_vars.toggles["Micro Rotate"], prefilter_key)
+            proxy = apply_rotation(proxy, *headstone.rotation)
+            if not fused:
+                image = apply_rotation(headstone.original_image, *headstone.rotation)
+                headstone.modified_image = image
         except Exception as e:
             headstone.error = e
-            headstone.log_event("Encountered exception '{}' during rotation".format(str(e)))
+            headstone.log_event("Encountered exception '{}' during rotation".format(str(e)), stage="Rotate",
+                                duration=metrics.stage_time("Macro Rotate", "Micro Rotate"))
             traceback.print_exc()
             raise e
         else:
-            headstone.log_event("Rotated successfully")
+            headstone.log_event("Rotated successfully", stage="Rotate", duration=metrics.stage_time("Macro Rotate", "Micro Rotate"))
 
     if global_vars.toggles["Crop"]:
         try:
-            if global_vars.toggles["Micro Rotate"] or global_vars.toggles["Macro Rotate"]:
-                converted = Image.fromarray(cv2.cvtColor(headstone.modified_image, cv2.COLOR_BGR2RGB))
-            else:
-                converted = Image.fromarray(cv2.cvtColor(headstone.original_image, cv2.COLOR_BGR2RGB))
-            cropped = crop(converted, global_vars.options["Cropping Buffer"])
-            headstone.modified_image = cv2.cvtColor(np.array(cropped), cv2.COLOR_RGB2BGR)
+            # The box is predicted on the (rotated) proxy and the full image is only sliced, not copied
+            if image is None:
+                image = headstone.original_image
+            height, width = image.shape[0:2]
+            if fused:
+                _, width, height = rotation_matrix(width, height, *headstone.rotation)
+
+            with metrics.stage("Crop"):
+                headstone.crop_box = find_crop_box(proxy, width, height, global_vars.options["Cropping Buffer"])
+
+                if fused:
+                    headstone.modified_image = rotate_and_crop(image, *headstone.rotation, headstone.crop_box)
+                else:
+                    top, bottom, left, right = headstone.crop_box
+                    headstone.modified_image = image[top:bottom, left:right]
         except Exception as e:
             headstone.error = e
-            headstone.log_event("Encountered exception '{}' during cropping".format(str(e)))
+            headstone.log_event("Encountered exception '{}' during cropping".format(str(e)), stage="Crop")
             #traceback.print_exc()
             raise e
         else:
-            headstone.log_event("Cropped successfully")
+            headstone.log_event("Cropped successfully", stage="Crop")
 
     if not (global_vars.toggles["Macro Rotate"] or global_vars.toggles["Micro Rotate"] or global_vars.toggles["Crop"]):
         headstone.modified_image = headstone.original_image
     
 
 
+# With a fused transform the rotated full image is never built:
+# rotation and cropping are applied together once the crop box is known
+def is_fused():
+    return global_vars.performance["Fused Transform"] and global_vars.toggles["Crop"] and \
+           (global_vars.toggles["Micro Rotate"] or global_vars.toggles["Macro Rotate"])
+
+
+# Rebuild the modified image from results found in the result cache, without running any of the models
+def restore_image(headstone, cached):
+    headstone.rotation = cached["Rotation"]
+    headstone.crop_box = cached["Crop Box"]
+    headstone.ocr_text = cached["OCR Text"]
+
+    image = headstone.original_image
+
+    if is_fused():
+        headstone.modified_image = rotate_and_crop(image, *headstone.rotation, headstone.crop_box)
+    else:
+        if global_vars.toggles["Micro Rotate"] or global_vars.toggles["Macro Rotate"]:
+            image = apply_rotation(image, *headstone.rotation)
+
+        if global_vars.toggles["Crop"]:
+            top, bottom, left, right = headstone.crop_box
+            image = image[top:bottom, left:right]
+
+        headstone.modified_image = image
+
+    headstone.log_event("Rotation, cropping and OCR results restored from the result cache", stage="Cache")
+
+
 def label_image(headstone): 
-    if global_vars.toggles["OCR"]:
+    # OCR text may already be known from the result cache
+    if global_vars.toggles["OCR"] and headstone.ocr_text is None:
         try:
             headstone.ocr_text = OCR(headstone.modified_image, global_vars.options["OCR Technique"] == "Google Cloud Vision")
         except Exception as e:
             headstone.error = e
-            headstone.log_event("Encountered exception '{}' during OCR".format(str(e)))
+            headstone.log_event("Encountered exception '{}' during OCR".format(str(e)), stage="OCR",
+                                duration=metrics.stage_time("Detect", "Recognize"))
             traceback.print_exc()
             raise e
 
+        if global_vars.performance["Result Cache"]:
+            result_cache.store(headstone)
+
+    if global_vars.toggles["OCR"]:
         # Convert ocr_text into the headstone's text fields
         try:
-            categorize_ocr_output(headstone)
+            with metrics.stage("Categorize"):
+                categorize_ocr_output(headstone)
         except Exception as e:
             traceback.print_exc()
         
         if global_vars.toggles["Label"]:
             try:
-                labeling.driver_labeling(headstone)
+                with metrics.stage("Label"):
+                    labeling.driver_labeling(headstone)
             except exceptions.LabelError as e:
                 if headstone.error is None:
                     headstone.error = e
-                headstone.log_event("Encountered exception '{}' during driver labeling".format(str(e)))
+                headstone.log_event("Encountered exception '{}' during driver labeling".format(str(e)), stage="Label")
                 raise e
             else:
-                headstone.log_event("Labeled successfully with label '{}'".format(headstone.label))
+                headstone.log_event("Labeled successfully with label '{}'".format(headstone.label), stage="Label")
         else:
             e = exceptions.LabelError(situation=exceptions.LabelError.Situations.Manual)
             headstone.error = e
@@ -220,5 +313,8 @@ if __name__ == "__main__":
 
     main_window.mainloop()
 
+    # Pages confirmed in batch review may still be being labeled
+    batch_review.wait()
+
     if data_loaded:
         labeling.write_data()
\ No newline at end of file
@@ -0,0 +1,169 @@
+# Headstone Photograph Processing System
+# Event Log
+# Structured log of the events that happen to each image, written to the Log File as JSON lines:
+#   {"Time": ..., "Process": ..., "Image": ..., "Stage": ..., "Event": ..., "Duration": ...}
+#
+# Events are kept in a bounded buffer in memory and appended to the Log File by a background thread,
+# every flush_interval seconds or as soon as the buffer is half full
+# If the buffer fills up faster than it can be written, logging waits for the write instead of dropping events
+# Each flush is a single append, under an exclusive file lock where the system supports it (fcntl),
+# so several threads and processes can share one Log File
+#
+# To show the events of one image:
+#   python event_log.py <image filename> [log file]
+
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from global_vars import global_vars
+
+# Seconds between background flushes
+flush_interval = 1.0
+
+# Most events held in memory before logging waits for them to be written
+max_buffer = 10000
+
+event_log = None
+
+# Held while the log is opened or closed, so threads logging first never open it twice
+open_lock = threading.Lock()
+
+
+class Event_Log:
+    def __init__(self, path):
+        self.path = path
+        self.buffer = collections.deque()
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.closed = False
+
+        self.flusher = threading.Thread(target=self.flush_loop, name="Event Log", daemon=True)
+        self.flusher.start()
+
+    def log(self, image, stage, event, duration=None):
+        entry = {
+            "Time": time.time(),
+            "Process": os.getpid(),
+            "Image": image,
+            "Stage": stage,
+            "Event": event,
+            "Duration": duration
+        }
+
+        with self.condition:
+            self.buffer.append(entry)
+            full = len(self.buffer) >= max_buffer
+            if len(self.buffer) >= max_buffer // 2:
+                self.condition.notify()
+
+        if full:
+            self.flush()
+
+    def flush_loop(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.buffer) < max_buffer // 2:
+                    self.condition.wait(flush_interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                return
+
+    # Append every buffered event to the Log File
+    def flush(self):
+        with self.write_lock:
+            with self.condition:
+                entries = list(self.buffer)
+                self.buffer.clear()
+            if len(entries) == 0:
+                return
+
+            data = ''.join([json.dumps(entry) + '\n' for entry in entries])
+            with open(self.path, 'a') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(data)
+                    f.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    # Write out everything left and stop the background thread
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.flusher.join()
+
+
+# Open the event log on the Log File
+# Does nothing if it's already open
+def open_log():
+    global event_log
+    with open_lock:
+        if event_log is None:
+            event_log = Event_Log(global_vars.parameters["Log File"])
+        return event_log
+
+
+# Log event for image, during stage
+def log(image, stage, event, duration=None):
+    open_log().log(image, stage, event, duration)
+
+
+def flush():
+    if event_log is not None:
+        event_log.flush()
+
+
+def close():
+    global event_log
+    with open_lock:
+        if event_log is not None:
+            event_log.close()
+            event_log = None
+
+
+# Read the events back from a Log File
+# Lines that aren't events (such as logs from older versions) are skipped
+def read_events(path):
+    events = list()
+    with open(path) as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass
+    return events
+
+
+# Don't lose buffered events if the program exits without closing the log
+atexit.register(close)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python event_log.py <image filename> [log file]")
+        sys.exit(1)
+
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+    else:
+        global_vars.init_working_folder()
+        path = global_vars.parameters["Log File"]
+    for entry in read_events(path):
+        if entry["Image"] == sys.argv[1]:
+            duration = "" if entry["Duration"] is None else " ({:.3f} s)".format(entry["Duration"])
+            print("{}  {:<12} {}{}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["Time"])),
+                                          entry["Stage"] or "", entry["Event"], duration))
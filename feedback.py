@@ -1,4 +1,8 @@
 import tkinter as tk
+import copy
+import queue
+import threading
+import traceback
 import global_vars
 import color_palette
 import PIL
@@ -8,6 +12,8 @@ import cv2
 from headstone import Headstone
 import pandas as pd
 import labeling
+import thumbnails
+import batch_review
 
 color = color_palette.color_pallette
 global_vars = global_vars.global_vars
@@ -65,16 +71,7 @@ class Single_Picture(tk.Frame):
         
 
     def update(self, headstone):
-        if self.is_original:
-            image = headstone.original_image
-        else:
-            image = headstone.modified_image
-
-        new_height = 400
-        scale = new_height/image.shape[0]
-        new_width = int(image.shape[1] * scale)
-        dim = (new_width, new_height)
-        scaled_image = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
+        scaled_image = thumbnails.open_cache().get(headstone, "Original" if self.is_original else "Modified")
         
         self.im = ImageTk.PhotoImage(PIL.Image.fromarray(cv2.cvtColor(scaled_image, cv2.COLOR_BGR2RGB)))
         self.img.config(image=self.im)
@@ -90,11 +87,16 @@ class Matches_Area(tk.Frame):
         self.label.pack()
 
         self.buttons = Match_Buttons_Subarea(self, functions[2])
-        self.control = Control_Buttons(self, functions[0:2])
+        self.control = Control_Buttons(self, functions[0:2] + functions[3:4])
 
     def update(self, search_df):
+        self.label.config(text="Possible Matches")
         self.buttons.update(search_df)
 
+    # Scoring the matches failed; the matches shown are left as they were
+    def failed(self):
+        self.label.config(text="Possible Matches (scoring failed, try searching again)")
+
 
 
 class Match_Buttons_Subarea(tk.Frame):
@@ -105,15 +107,18 @@ class Match_Buttons_Subarea(tk.Frame):
         self.pack(fill="both", expand=True)
         self.buttons = list()
     
+    # Buttons are made once and reused; the ones not needed are hidden
     def update(self, search_df):
-        for button in self.buttons:
-            button.destroy()
-
-        if search_df is not None:
+        entries = list() if search_df is None else search_df.to_dict(orient="records")
 
-            dicts_df = search_df.to_dict(orient="records")
-            for entry in dicts_df:
+        for i, entry in enumerate(entries):
+            if i < len(self.buttons):
+                self.buttons[i].set_entry(entry)
+            else:
                 self.buttons.append(Match_Button(self, entry, self.label_function))
+
+        for button in self.buttons[len(entries):]:
+            button.pack_forget()
         
 
 class Match_Button(tk.Button):
@@ -127,6 +132,12 @@ class Match_Button(tk.Button):
         self.master = master
         self.pack(fill="x")
 
+    def set_entry(self, entry):
+        self.entry = entry
+        self.config(text=self.format_entry(entry))
+        if self.winfo_manager() == "":
+            self.pack(fill="x")
+
     def select(self):
         self.label_function(self.entry)
 
@@ -176,7 +187,7 @@ class Control_Buttons(tk.Frame):
         super().__init__(master, bg=color.bg)
         self.master = master
         self.pack(fill="both", side="bottom")
-        self.return_func, self.update = functions
+        self.return_func, self.update, self.batch_func = functions
 
 
         self.return_button = tk.Button(self, text="Return", command=self.return_func,
@@ -187,8 +198,13 @@ class Control_Buttons(tk.Frame):
                                      highlightthickness=0, bg=color.accent, fg=color.fg, 
                                      activeforeground=color.bg, activebackground=color.fg)
 
+        self.batch_button = tk.Button(self, text="Batch Review", command=self.batch_func,
+                                      highlightthickness=0, bg=color.accent, fg=color.fg, 
+                                      activeforeground=color.bg, activebackground=color.fg)
+
         self.return_button.pack(fill="x", expand=True, side="left")
         self.skip_button.pack(fill="x", expand=True, side="left")
+        self.batch_button.pack(fill="x", expand=True, side="left")
 
     def skip(self):
         global_vars.feedback_queue.append(global_vars.feedback_queue.pop(0))
@@ -196,6 +212,9 @@ class Control_Buttons(tk.Frame):
 
 
 class Search_Area(tk.Frame):
+    # Milliseconds after the last key press before searching
+    search_delay = 250
+
     def __init__(self, master, parent_search):
         super().__init__(master, bg=color.bg)
         self.master = master
@@ -203,9 +222,12 @@ class Search_Area(tk.Frame):
         self.pack(fill="both", expand=True, side="left", pady=(25, 0))
 
         self.fields = dict()
+        self.last_data = None
+        self.after_id = None
 
         for k in Headstone.text_field_keys:
             self.fields[k] = Label_Entry_Pair(self, k)
+            self.fields[k].entry.bind("<KeyRelease>", self.schedule_search)
 
         self.search_button = tk.Button(self, text="Search", command=self.search,
                                        highlightthickness=0, bg=color.accent, fg=color.fg, 
@@ -215,13 +237,33 @@ class Search_Area(tk.Frame):
 
 
     def search(self):
+        self.cancel_search()
         data = {k: self.fields[k].entry.get() for k in self.fields.keys()}
+        self.last_data = data
         self.parent_search(data)
 
+    # Search as the user types, once they stop for search_delay
+    def schedule_search(self, event=None):
+        self.cancel_search()
+        self.after_id = self.after(self.search_delay, self.search_if_changed)
+
+    def search_if_changed(self):
+        self.after_id = None
+        data = {k: self.fields[k].entry.get() for k in self.fields.keys()}
+        if data != self.last_data:
+            self.search()
+
+    def cancel_search(self):
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+
     def update(self, headstone):
+        self.cancel_search()
         for k, v in self.fields.items():
             v.entry.delete(0, len(v.entry.get()))
             v.entry.insert(0, headstone.text_fields[k])
+        self.last_data = {k: headstone.text_fields[k] for k in self.fields.keys()}
 
 
 class Label_Entry_Pair(tk.Frame):
@@ -239,33 +281,122 @@ class Label_Entry_Pair(tk.Frame):
 
 
 class Feedback_Screen(tk.Frame):
+    # Milliseconds between checks for background re-scores
+    rescore_interval = 100
+
     def __init__(self, master, processing_screen):
         super().__init__(master, bg=color.bg)
         self.master = master
         self.processing_screen = processing_screen
         self.headstone = None
+        self.searcher = None
+
+        # Matches shown are only replaced by a re-score or search of the same generation
+        self.generation = 0
+        self.rescored = queue.Queue()
+        self.num_rescoring = 0
+        self.after_id = None
 
         self.pictures = Pictures_Area(self, self.error_headstone)
-        self.matches = Matches_Area(self, (self.switch_to_processing_screen, self.update, self.label_headstone))
+        self.matches = Matches_Area(self, (self.switch_to_processing_screen, self.update, self.label_headstone,
+                                           self.switch_to_batch_review))
         self.search = Search_Area(self, self.update_buttons)
 
+        self.batch_review = batch_review.Batch_Review_Screen(master, self)
+
 
     def switch_to_processing_screen(self):
-        self.pack_forget()
+        self.leave()
         self.processing_screen.pack(fill="both", expand=True)
         self.processing_screen.update()
 
+    def switch_to_batch_review(self):
+        self.leave()
+        self.batch_review.show()
+
+    def leave(self):
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+        self.pack_forget()
+
     def update(self):
+        # Images that can't be loaded any more (e.g. their modified image failed to write) are taken out of the queue
+        while len(global_vars.feedback_queue) > 0:
+            try:
+                self.headstone = Headstone.load(global_vars.feedback_queue[0])
+                break
+            except Exception:
+                traceback.print_exc()
+                global_vars.feedback_queue.pop(0)
+
         if len(global_vars.feedback_queue) == 0:
             self.switch_to_processing_screen()
             return
 
-        self.headstone = Headstone.load(global_vars.feedback_queue[0])
+        self.searcher = labeling.Search()
         self.pictures.update(self.headstone)
-        self.matches.update(labeling.feedback_labeling(self.headstone))
+        thumbnails.open_cache().prefetch(global_vars.feedback_queue[1:1 + thumbnails.prefetch_count])
+        self.generation += 1
+
+        # The candidates found while processing are shown straight away,
+        # and scored again in the background if any assignments changed since
+        candidates = self.headstone.candidates
+        self.matches.update(None if candidates is None else pd.DataFrame(candidates))
+        if candidates is None or self.headstone.candidates_version != labeling.get_assignments_version():
+            self.rescore()
+
         self.search.update(self.headstone)
         
 
+    # Score the matches of the headstone being reviewed again, in a background thread
+    def rescore(self):
+        generation = self.generation
+        headstone = copy.copy(self.headstone)
+        headstone.text_fields = dict(self.headstone.text_fields)
+
+        def score():
+            return labeling.feedback_labeling(headstone)
+
+        self.start_scoring(score, generation, "Feedback Rescore")
+
+    # Run target (returning the matches found) in a background thread, for the matches of generation
+    # A result is always put in self.rescored, even if target fails, so poll_rescore knows when to stop
+    def start_scoring(self, target, generation, name):
+        def run():
+            version = labeling.get_assignments_version()
+            result = (generation, version, None, True)
+            try:
+                result = (generation, version, target(), False)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.rescored.put(result)
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+        self.num_rescoring += 1
+        if self.after_id is None:
+            self.after_id = self.after(self.rescore_interval, self.poll_rescore)
+
+    def poll_rescore(self):
+        self.after_id = None
+        while not self.rescored.empty():
+            generation, version, match_df, failed = self.rescored.get()
+            self.num_rescoring -= 1
+
+            if generation == self.generation and failed:
+                self.matches.failed()
+            elif generation == self.generation:
+                self.matches.update(match_df)
+                self.headstone.candidates = None if match_df is None else match_df.to_dict(orient="records")
+                self.headstone.candidates_version = version
+
+        if self.num_rescoring > 0:
+            self.after_id = self.after(self.rescore_interval, self.poll_rescore)
+
+
+    # Search for the fields the user entered, in a background thread
+    # A search still running for older fields stops as soon as it notices it's out of date
     def update_buttons(self, data):
         if self.headstone is None:
             return
@@ -273,9 +404,16 @@ class Feedback_Screen(tk.Frame):
         for k, v in data.items():
             self.headstone.text_fields[k] = v
 
-        search_df = labeling.feedback_labeling(self.headstone)
+        # A re-score still running is for the old fields
+        self.generation += 1
+        generation = self.generation
+        searcher = self.searcher
+        fields = dict(self.headstone.text_fields)
+
+        def search():
+            return searcher.run(fields, cancelled=lambda: self.generation != generation)
 
-        self.matches.update(search_df)
+        self.start_scoring(search, generation, "Feedback Search")
 
 
     def label_headstone(self, entry):
@@ -287,7 +425,7 @@ class Feedback_Screen(tk.Frame):
         labeling.set_fuzziness(entry, 100)
         self.headstone.set_label(global_vars.options["Label Format"].format(entry))
         self.headstone.error = None
-        self.headstone.log_event("Manually labeled with label '{}'".format(self.headstone.label))
+        self.headstone.log_event("Manually labeled with label '{}'".format(self.headstone.label), stage="Feedback")
         self.headstone.move("Destination Folder", target="MODIFIED", apply_label=True)
         self.headstone.save()
         #print(self.headstone)
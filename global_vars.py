@@ -13,6 +13,25 @@
 #   > Fuzzy Matches (Reject, Request Confirmation, or Accept): How the program should handle imperfect near-matches for the labeling system
 #   > Fuzziness Threshold: An integer from 0 to 100 controlling how close a fuzzy match must be to be considered
 #   > Error Processing (True or False): Identifies if the images to be processed have already been partially-processed
+#
+# Performance (only set through the settings file)
+#   > Fused Transform (True or False): Apply rotation and cropping as one transform, without building the full rotated image
+#   > Orientation Prefilter (True or False): Skip the macro rotation model for photos a cheap pre-check trusts to be upright
+#   > Result Cache (True or False): Reuse rotation, cropping and OCR results of photos that were already processed
+#   > Result Cache Size: The maximum number of photos the result cache remembers
+#   > Stage Timing (True or False): Write per-image stage timings and counters, and a summary of them, to files
+#   > Metrics Port: Port to serve runtime metrics on for monitoring (see metrics_exporter.py), or 0 to not serve them
+#   > Profiling: Off, cProfile or Sampling (see profiling.py)
+#   > Profiling Stages: Comma separated stages to profile, or nothing to profile whole images
+#   > Profile Every: Profile one image out of every this many
+#   > Writer Threads: Threads writing images in the background, or 0 to write them as they're made (see image_writer.py)
+#   > JPEG Quality: Quality of the images written, 0 to 100
+#   > JPEG Progressive (True or False): Write progressive JPEGs
+#   > JPEG Optimize (True or False): Optimize the JPEG Huffman tables (smaller files, slower to write)
+#   > Lossless Copy (True or False): Keep the original JPEG data of images that were not rotated
+#   > Fsync Every: Flush written images to disk after every this many, or 0 to leave it to the operating system
+#   > Watch Folder (True or False): Keep processing photos added to the Image Folder until aborted
+#   > Watch Stable Seconds: How long a new photo must stay unchanged before it's processed
 
 import collections
 import os
@@ -45,8 +64,31 @@ default_settings = {
     "Crop": True,
     "OCR": True,
     "Label": True,
+    "Fused Transform": False,
+    "Orientation Prefilter": False,
+    "Result Cache": False,
+    "Result Cache Size": 10000,
+    "Stage Timing": False,
+    "Metrics Port": 0,
+    "Profiling": "Off",
+    "Profiling Stages": "",
+    "Profile Every": 1,
+    "Writer Threads": 0,
+    "JPEG Quality": 95,
+    "JPEG Progressive": False,
+    "JPEG Optimize": False,
+    "Lossless Copy": False,
+    "Fsync Every": 0,
+    "Watch Folder": False,
+    "Watch Stable Seconds": 2.0,
 }
 
+# Settings that only tune how fast the system runs, not what it produces
+performance_settings = ("Fused Transform", "Orientation Prefilter", "Result Cache", "Result Cache Size", "Stage Timing", "Metrics Port",
+                        "Profiling", "Profiling Stages", "Profile Every",
+                        "Writer Threads", "JPEG Quality", "JPEG Progressive", "JPEG Optimize", "Lossless Copy", "Fsync Every",
+                        "Watch Folder", "Watch Stable Seconds")
+
 class Global_Vars:
     def __init__(self):
         if os.path.isfile(settings_file):
@@ -56,8 +98,6 @@ class Global_Vars:
 
         self.feedback_queue = list()
         self.initialized = False
-        self.log = ""
-        self.prev_log = ""
 
     def default_init(self):
         # Default values for the parameters
@@ -88,6 +128,10 @@ class Global_Vars:
         self.toggles["OCR"] = True
         self.toggles["Label"] = True
 
+        self.performance = collections.OrderedDict()
+        for setting in performance_settings:
+            self.performance[setting] = default_settings[setting]
+
 
     def file_init(self):
         with open(settings_file) as f:
@@ -152,11 +196,24 @@ class Global_Vars:
             except Exception as e:
                 self.toggles[toggle] = True
 
+        # Performance settings are parsed to the type of their default value
+        self.performance = collections.OrderedDict()
+        for setting in performance_settings:
+            default = default_settings[setting]
+            try:
+                if isinstance(default, bool):
+                    assert settings[setting].lower() in ("true", "false")
+                    self.performance[setting] = settings[setting].lower() == "true"
+                else:
+                    self.performance[setting] = type(default)(settings[setting])
+            except Exception as e:
+                self.performance[setting] = default
+
 
     # Return a string detailing all of the parameters and options neatly
     def __str__(self):
         output = ""
-        for d in [self.parameters, self.options]:
+        for d in [self.parameters, self.options, self.performance]:
             for k, v in d.items():
                 output += f'{k}:'.ljust(30) +  f'{v}\n'
         return output
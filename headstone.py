@@ -1,67 +1,149 @@
 import pickle
 import cv2
 import os
-import subprocess
-from global_vars import global_vars, slash
 import threading
+import uuid
+from PIL import Image
+from global_vars import global_vars, slash
+import metrics
+import event_log
+import metadata_store
+import name_registry
+import image_writer
+import exceptions
 
 #global_vars = global_vars.global_vars
 
 # Class to organize all the relevant information for a particular headstone image
-# Image metadata is saved by serializing this object
+# Image metadata is saved by serializing this object into the metadata store
 class Headstone():
     text_field_keys = ("First Name", "Middle Name", "Surname", "State", "Conflict", "Birth Date", "Death Date")
-    log_lock = threading.Lock()
+
+    # The proxy is decoded small enough to be cheap, but never smaller than the largest model input (448x448)
+    proxy_min_side = 448
+    reduced_decode_flags = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+    # A failed background write saves the headstone again from a writer thread (see write_failed)
+    # save() swaps the images out while pickling, so two saves of one headstone must not overlap
+    save_lock = threading.Lock()
 
     def __init__(self, path):
         self.original_filename = self.extract_filename(path)[1:]
         self.original_path = path
-        self.original_image = cv2.imread(path)
+        # Filenames repeat across cameras and batches, so saved metadata and thumbnails are keyed by this instead
+        self.image_id = uuid.uuid4().hex
+        self._original_image = None
+        self._proxy_image = None
         self.modified_path = None
-        self.modified_image = None
+        self._modified_image = None
+        self.rotation = (None, 0)
+        self.crop_box = None
+        self.content_hash = None
         self.error = None
         self.ocr_text = None
         self.text_fields = {k:'' for k in Headstone.text_field_keys}
         self.label = None
         self.fuzziness_score = None
+        self.candidates = None
+        self.candidates_version = None
         self.as_string = None
         self.log = '\n\nLog:'
 
 
-    # Save metadata in same location as images (original and modified)
-    def save(self):
-        # Replace the numpy representations of image with None so that
-        # they aren't saved in the save file, which would take unnecesary space
-        original_backup = self.original_image
-        self.original_image = None
+    # Full resolution images are only decoded the first time they are needed
+    # Stages that only feed the models should use proxy_image instead
+    @property
+    def original_image(self):
+        if getattr(self, '_original_image', None) is None and self.original_path is not None:
+            with metrics.stage("Decode"):
+                self._original_image = cv2.imread(self.original_path)
+        return self._original_image
+
+    @original_image.setter
+    def original_image(self, image):
+        self._original_image = image
+
+    @property
+    def modified_image(self):
+        if getattr(self, '_modified_image', None) is None and self.modified_path is not None:
+            image_writer.wait(self.modified_path)
+            with metrics.stage("Decode"):
+                self._modified_image = cv2.imread(self.modified_path)
+        return getattr(self, '_modified_image', None)
+
+    @modified_image.setter
+    def modified_image(self, image):
+        self._modified_image = image
+
+    # Reduced resolution copy of the original image, used as input for the models
+    # JPEGs are downscaled while decoding (in the DCT domain), so the full image is never built
+    @property
+    def proxy_image(self):
+        if getattr(self, '_proxy_image', None) is None:
+            if getattr(self, '_original_image', None) is not None:
+                self._proxy_image = self.downscale(self._original_image, Headstone.proxy_min_side)
+            else:
+                self._proxy_image = self.read_proxy(self.original_path, Headstone.proxy_min_side)
+        return self._proxy_image
+
+    # Decode the image at path at the largest reduction that keeps its shorter side at least min_side
+    @staticmethod
+    @metrics.timed("Decode")
+    def read_proxy(path, min_side):
+        with Image.open(path) as im:
+            short_side = min(im.size)
+
+        for factor, flag in Headstone.reduced_decode_flags:
+            if short_side // factor >= min_side:
+                return cv2.imread(path, flag)
 
-        modified_backup = self.modified_image
-        self.modified_image = None
+        return cv2.imread(path)
+
+    # Same reduction as read_proxy, for an image that has already been decoded
+    @staticmethod
+    def downscale(image, min_side):
+        short_side = min(image.shape[0:2])
 
-        self.as_string = '\n\n' + str(self) + '\n\n'
+        for factor, flag in Headstone.reduced_decode_flags:
+            if short_side // factor >= min_side:
+                dim = (image.shape[1] // factor, image.shape[0] // factor)
+                return cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
 
-        for path in (self.original_path, self.modified_path):
-            if path is None:
-                continue
+        return image
 
-            save_file = path.replace(".JPG", ".pickle")
+
+    # Save metadata to the metadata store, under the image id
+    @metrics.timed("Write")
+    def save(self):
+        with Headstone.save_lock:
+            # Replace the numpy representations of image with None so that
+            # they aren't saved in the save file, which would take unnecesary space
+            original_backup = getattr(self, '_original_image', None)
+            self._original_image = None
+
+            proxy_backup = getattr(self, '_proxy_image', None)
+            self._proxy_image = None
+
+            modified_backup = getattr(self, '_modified_image', None)
+            self._modified_image = None
+
+            self.as_string = '\n\n' + str(self) + '\n\n'
 
             try:
-                if os.path.isfile(save_file):
-                    os.remove(save_file)
-                with open(save_file, 'wb') as f:
-                    pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+                data = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+                metadata_store.open_store().put(self.image_id, self.original_filename, self.original_path, self.modified_path,
+                                                self.situation(), self.fuzziness_score, self.label, data)
             except:
                 pass
 
-            self.hide_file(save_file)
-
-        # Restore backups
-        self.original_image = original_backup
-        self.modified_image = modified_backup
+            # Restore backups
+            self._original_image = original_backup
+            self._proxy_image = proxy_backup
+            self._modified_image = modified_backup
 
 
     # Save the modified as an image on disk
+    @metrics.timed("Write")
     def write_modified(self, dest_folder, apply_label=False):
         if self.modified_image is None:
             raise Exception("image not modified")
@@ -73,16 +155,39 @@ class Headstone():
         new_path = global_vars.parameters.get(dest_folder) + filename
         new_path = self.overwrite_protection(new_path)
 
-        # PIL.Image.fromarray(self.modified_image).save(new_path)
-        cv2.imwrite(new_path, self.modified_image)
+        # The original JPEG data can be kept if the image was never rotated
+        source = None
+        if self.rotation == (None, 0):
+            source = (self.original_path, self.crop_box)
 
+        # Set before the write starts, so a write that fails straight away still finds it in write_failed
+        previous_path = self.modified_path
         self.modified_path = new_path
+        try:
+            image_writer.write(new_path, self.modified_image, source, on_failure=lambda e: self.write_failed(new_path, e))
+        except Exception:
+            self.modified_path = previous_path
+            name_registry.release(new_path)
+            raise
 
         self.log_event("Modified image written to " + dest_folder)
 
+    # Called from a writer thread when writing the modified image to path failed
+    # The name is given back, and the failure saved, so the metadata doesn't point at an image that doesn't exist
+    def write_failed(self, path, error):
+        name_registry.release(path)
+        metrics.record_error(error)
+        self.log_event("Encountered exception '{}' writing the modified image".format(error), stage="Write", duration=0)
+
+        if self.modified_path == path:
+            self.modified_path = None
+            self.error = error
+            self.save()
+
 
     # Move either the original image or the modified image to a new folder
     # Target must be "ORIGINAL" or "MODIFIED"
+    @metrics.timed("Write")
     def move(self, dest_folder, target="ORIGINAL", apply_label=False):
         if dest_folder not in global_vars.parameters.keys():
             raise Exception("invalid dest_folder")
@@ -106,13 +211,9 @@ class Headstone():
 
         new_path = global_vars.parameters.get(dest_folder) + filename
         new_path = self.overwrite_protection(new_path)
+        image_writer.wait(path)
         os.replace(path, new_path)
-
-        # Move the corresponding save data if it exists
-        save_file = self.get_save_path(path)
-        if os.path.isfile(save_file):
-            new_save = self.get_save_path(new_path)
-            os.replace(save_file, new_save)
+        name_registry.release(path)
 
         # Update path
         if target == "ORIGINAL":
@@ -122,35 +223,50 @@ class Headstone():
 
         self.log_event(target.title() + " image moved to " + dest_folder)
 
-    # Maintain a log of events that happen to this headstone while processing
-    def log_event(self, event):
+    # Maintain a log of events that happen to this headstone while processing, and add them to the event log
+    # The stage defaults to the stage being timed; given a stage, the duration defaults to the time spent in it so far
+    def log_event(self, event, stage=None, duration=None):
         self.log += '\t' + event + '\n'
 
-        Headstone.log_lock.acquire()
-        if global_vars.prev_log != self.original_filename:
-            if global_vars.prev_log != '':
-                global_vars.log += '\n' 
-            global_vars.prev_log = self.original_filename
-        
-        global_vars.log += self.original_filename + '\t' + event + '\n'
-        Headstone.log_lock.release()
+        if stage is None:
+            stage = metrics.current_stage()
+        elif duration is None:
+            duration = metrics.stage_time(stage)
 
+        event_log.log(self.original_filename, stage, event, duration)
 
-    # Load class from pickle file
-    @staticmethod
-    def load(path):
-        save_file = path.replace(".JPG", ".pickle")
 
-        if os.name == 'posix':
-            directory, filename = save_file.rsplit('/', 1)
-            save_file = directory + '/.' + filename 
+    # Name of the situation the headstone was left in: the LabelError situation, the type of any other error, or None
+    def situation(self):
+        if self.error is None:
+            return None
+        if isinstance(self.error, exceptions.LabelError):
+            return self.error.situation.name
+        return type(self.error).__name__
 
-        with open(save_file, 'rb') as f:
-            loaded = pickle.load(f)
+    # Load class from the metadata store, given the path of either of its images
+    # Images saved before the metadata store have their pickle file next to the image instead
+    # Images are not decoded here, they are decoded when first accessed
+    @staticmethod
+    def load(path):
+        data = metadata_store.open_store().get(path)
 
-        loaded.original_image = cv2.imread(loaded.original_path)
-        if loaded.modified_path is not None:
-            loaded.modified_image = cv2.imread(loaded.modified_path)
+        if data is not None:
+            loaded = pickle.loads(data)
+        else:
+            with open(Headstone.get_save_path(path), 'rb') as f:
+                loaded = pickle.load(f)
+
+        # Older save files stored the images as plain attributes
+        loaded.__dict__.pop('original_image', None)
+        loaded.__dict__.pop('modified_image', None)
+        loaded._original_image = None
+        loaded._proxy_image = None
+        loaded._modified_image = None
+        loaded.__dict__.setdefault('candidates', None)
+        loaded.__dict__.setdefault('candidates_version', None)
+        # Images saved before image ids were keyed by their original filename
+        loaded.__dict__.setdefault('image_id', loaded.original_filename)
 
         return loaded
 
@@ -168,23 +284,8 @@ class Headstone():
     def set_label(self, label):
         self.label = label + ".JPG"
 
-    # Marks the file located at "path" to be hidden
-    # Works on both Windows and Linux
-    @staticmethod
-    def hide_file(path):
-        # Windows
-        if os.name == 'nt':
-            subprocess.check_call(["attrib","+H", path])
-
-        # Linux
-        else:
-            # Separate path into directory and filename
-            directory, filename = path.rsplit('/', 1)
-            new_path = directory + '/.' + filename 
-            os.replace(path, new_path)
-
     # path: path to a .JPG file
-    # output: path to the corresponding .pickle file
+    # output: path to the corresponding .pickle file, for images saved before the metadata store
     @staticmethod
     def get_save_path(path):
         path = path.replace(".JPG", ".pickle")
@@ -205,14 +306,7 @@ class Headstone():
     # Otherwise return path unchanged
     @staticmethod
     def overwrite_protection(path):
-        if os.path.isfile(path):
-            i = 1
-            no_extension = path.replace('.JPG', '')
-            while os.path.isfile(no_extension + f" ({i}).JPG"):
-                i += 1
-            path = no_extension + f" ({i}).JPG"
-
-        return path
+        return name_registry.reserve(path)
 
 
     def __str__(self):
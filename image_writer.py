@@ -0,0 +1,204 @@
+# Headstone Photograph Processing System
+# Image Writer
+# Encodes and writes the modified images, in a pool of background threads so encoding overlaps with the models
+#
+# Set in the settings file:
+#   > Writer Threads: Threads encoding and writing images in the background, or 0 to write them on the driver thread
+#   > JPEG Quality: 0 to 100
+#   > JPEG Progressive, JPEG Optimize (True or False): Progressive encoding, optimized Huffman tables (smaller files, slower)
+#   > Lossless Copy (True or False): When an image wasn't rotated, keep the original JPEG data instead of encoding it again
+#       An uncropped image is copied as is; a cropped one is cut with jpegtran (if installed), which has to extend
+#       the crop box up and to the left to the nearest 8 or 16 pixel block boundary
+#   > Fsync Every: Flush written images to disk after every this many, or 0 to leave it to the operating system
+#
+# Every image is written to a temporary file and renamed into place, so a half written image is never seen
+# Anything about to read or move an image being written waits for it with wait(path)
+# A background write that fails is reported to the on_failure given with it, not to whatever waits for it later
+
+import os
+import shutil
+import subprocess
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+from PIL import Image
+
+import metrics
+from global_vars import global_vars
+
+# Most images waiting to be written before the driver waits for the writer to catch up
+max_pending = 16
+
+writer = None
+
+
+class Image_Writer:
+    def __init__(self, num_threads, quality=95, progressive=False, optimize=False, lossless=False, fsync_every=0):
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality,
+                       cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive),
+                       cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize)]
+        self.lossless = lossless
+        self.jpegtran = shutil.which("jpegtran")
+        self.fsync_every = fsync_every
+
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.unsynced = list()
+
+        self.executor = None
+        if num_threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="Image Writer")
+            self.slots = threading.BoundedSemaphore(max_pending)
+
+    # Write image to path, in the background if there are writer threads
+    # source is (original path, crop box) if the original JPEG data may be kept instead (see Lossless Copy)
+    # Without writer threads a failed write raises here; in the background, on_failure is called with the exception
+    def write(self, path, image, source=None, on_failure=None):
+        if self.executor is None:
+            self.write_now(path, image, source)
+            return
+
+        self.slots.acquire()
+        with self.lock:
+            future = self.executor.submit(self.write_task, path, image, source, on_failure)
+            self.pending[path] = future
+
+    def write_task(self, path, image, source, on_failure):
+        try:
+            self.write_now(path, image, source)
+        except Exception as e:
+            traceback.print_exc()
+            if on_failure is not None:
+                try:
+                    on_failure(e)
+                except Exception:
+                    traceback.print_exc()
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+            self.slots.release()
+
+    def write_now(self, path, image, source):
+        directory, filename = os.path.split(path)
+        temp_path = os.path.join(directory, "." + filename + ".part")
+
+        try:
+            if not (self.lossless and source is not None and self.copy_original(temp_path, *source)):
+                success, data = cv2.imencode(".JPG", image, self.params)
+                if not success:
+                    raise Exception("could not encode " + path)
+                with open(temp_path, 'wb') as f:
+                    f.write(data.tobytes())
+
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.synced(path)
+
+    # Keep the original's JPEG data for an image that was only cropped, not rotated
+    # Returns False if the original can't be used
+    def copy_original(self, temp_path, original_path, crop_box):
+        try:
+            # cv2 decodes images upright; the original's data only matches if it's stored upright too
+            with Image.open(original_path) as im:
+                if im.format != "JPEG" or im.getexif().get(0x0112, 1) != 1:
+                    return False
+
+            if crop_box is None:
+                shutil.copyfile(original_path, temp_path)
+                return True
+
+            if self.jpegtran is None:
+                return False
+
+            top, bottom, left, right = crop_box
+            subprocess.check_call([self.jpegtran, "-copy", "all", "-crop", f"{right - left}x{bottom - top}+{left}+{top}",
+                                   "-outfile", temp_path, original_path])
+            return True
+        except (OSError, subprocess.CalledProcessError):
+            return False
+
+    # Flush written images to disk in batches of fsync_every
+    def synced(self, path):
+        if self.fsync_every <= 0:
+            return
+
+        with self.lock:
+            self.unsynced.append(path)
+            if len(self.unsynced) < self.fsync_every:
+                return
+            paths = self.unsynced
+            self.unsynced = list()
+
+        sync(paths)
+
+    # Wait until the image being written to path (if any) is done
+    # If it failed, it was already reported to its on_failure, and there is no image at path
+    def wait(self, path):
+        with self.lock:
+            future = self.pending.get(path)
+        if future is not None:
+            future.result()
+
+    # Wait until every image is written
+    def wait_all(self):
+        with self.lock:
+            futures = list(self.pending.values())
+        for future in futures:
+            future.result()
+
+        with self.lock:
+            paths = self.unsynced
+            self.unsynced = list()
+        if len(paths) > 0:
+            sync(paths)
+
+    def num_pending(self):
+        with self.lock:
+            return len(self.pending)
+
+    def close(self):
+        self.wait_all()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+# Flush the written files to disk
+# One sync of the whole system where available, instead of one fsync per file
+def sync(paths):
+    if hasattr(os, "sync"):
+        os.sync()
+    else:
+        for path in paths:
+            with open(path, 'rb+') as f:
+                os.fsync(f.fileno())
+
+
+# Start the writer as set in the performance settings
+# Does nothing if it's already started
+def open_writer():
+    global writer
+    if writer is None:
+        performance = global_vars.performance
+        writer = Image_Writer(performance["Writer Threads"], performance["JPEG Quality"], performance["JPEG Progressive"],
+                              performance["JPEG Optimize"], performance["Lossless Copy"], performance["Fsync Every"])
+        metrics.register_gauge("Writer", writer.num_pending)
+    return writer
+
+
+def write(path, image, source=None, on_failure=None):
+    open_writer().write(path, image, source, on_failure)
+
+
+def wait(path):
+    if writer is not None:
+        writer.wait(path)
+
+
+def wait_all():
+    if writer is not None:
+        writer.wait_all()
@@ -20,6 +20,7 @@ import glob
 import re
 import pandas as pd
 import traceback
+import threading
 
 import tkinter as tk
 from tkinter import filedialog
@@ -29,6 +30,8 @@ from global_vars import global_vars
 from color_palette import color_pallette as color
 from headstone import Headstone
 import exceptions
+import metadata_store
+import labeling
 
 #color = color_palette.color_pallette
 #global_vars = global_vars.global_vars
@@ -392,19 +395,9 @@ class Initialization_Screen(tk.Frame):
             
 
         # Initialize the feedback queue if feedback is enabled
+        # The queue is filled in the background, so processing can start straight away
         if global_vars.options.get("User Feedback") != "None":
-            paths = glob.glob(global_vars.parameters.get("Feedback Folder") + "/*.JPG")
-            for path in paths:
-                try:
-                    headstone = Headstone.load(path)
-                    e = headstone.error
-                    if global_vars.options["User Feedback"] == "Full" or \
-                    e is None or \
-                    e.situation in (exceptions.LabelError.Situations.Multiple_Perfect, exceptions.LabelError.Situations.Debugging) or \
-                    e.situation in (exceptions.LabelError.Situations.Fuzzy, exceptions.LabelError.Situations.Fuzzy_Tie) and global_vars.options["User Feedback"] != "Reject":
-                        global_vars.feedback_queue.append(path)
-                except Exception as e:
-                    traceback.print_exc()
+            threading.Thread(target=rescan_feedback_folder, name="Feedback Rescan", daemon=True).start()
 
         global_vars.initialized = True
         self.lock.release()
@@ -414,4 +407,30 @@ class Initialization_Screen(tk.Frame):
     def abort(self):
         self.lock.release()
         self.destroy()
-        self.master.destroy()
\ No newline at end of file
+        self.master.destroy()
+
+# Add the images left in the Feedback Folder by earlier runs to the feedback queue, as they are found
+# Situations are read from the metadata store; only images saved before the store existed have to be loaded
+def rescan_feedback_folder():
+    folder = global_vars.parameters.get("Feedback Folder")
+    paths = glob.glob(folder + "/*.JPG")
+    remaining = {os.path.normcase(os.path.normpath(path)): path for path in paths}
+
+    try:
+        rows = metadata_store.open_store().get_situations(folder)
+    except Exception:
+        traceback.print_exc()
+        rows = list()
+
+    for modified_path, situation in rows:
+        path = remaining.pop(os.path.normcase(os.path.normpath(modified_path)), None)
+        if path is not None and (situation is None or labeling.wants_feedback(situation)):
+            global_vars.feedback_queue.append(path)
+
+    for path in remaining.values():
+        try:
+            headstone = Headstone.load(path)
+            if headstone.situation() is None or labeling.wants_feedback(headstone.situation()):
+                global_vars.feedback_queue.append(path)
+        except Exception:
+            traceback.print_exc()
@@ -7,12 +7,46 @@ from headstone import Headstone
 import numpy as np
 import threading
 import os
+import uuid
 from functools import wraps
+import metrics
+import event_log
+import date_to_iso
 
 df = None
 dicts_df = None
 lock = threading.Lock()
 
+# Data file columns holding dates, which are compared numerically
+date_columns = ("Birth Date", "Death Date")
+
+# Date column -> (years, months, days) of every entry as integer arrays, 0 where the date doesn't have that part
+date_parts = dict()
+
+# Fields that make up the key of the exact match index
+exact_key_fields = ("Surname", "First Name", "Death Date")
+
+# Key -> indexes of the entries with that key (see get_exact_key)
+exact_index = dict()
+
+# Number of changes to the entries' fuzziness scores (assignments) so far
+# Candidates stored with a headstone are current as long as this hasn't changed since (see get_assignments_version)
+assignments_version = 0
+
+# The count starts again every time the system runs, so versions are only comparable within one run
+session_id = uuid.uuid4().hex
+
+# Number of candidates stored with a headstone
+num_candidates = 5
+
+# Data file column -> (codes, values, lengths) of every entry, for searching (see Search)
+#   values: the distinct upper case values of the column, codes: the index in values of every entry's value,
+#   lengths: the length of every entry's value
+search_columns = dict()
+
+# Fuzziness score of every entry when the data file was loaded, as an array
+loaded_fuzziness = None
+
 
 # Decorator function to allow only one thread access to a function at a time
 # Every locked function shares the same lock
@@ -51,7 +85,18 @@ def unlocked(func):
 # No return value (defaults to None)
 @locked
 def driver_labeling(headstone):
-    match_df = get_fuzzy_matches(headstone)
+    # Perfect matches can be found through the exact match index, without scoring every entry
+    perfect_indexes = get_exact_matches(headstone)
+    if perfect_indexes is not None and len(perfect_indexes) > 0:
+        if len(perfect_indexes) > 1:
+            store_candidates(headstone, df.iloc[perfect_indexes[:num_candidates]].assign(Fuzziness = 100.0))
+            raise exceptions.LabelError(exceptions.LabelError.Situations.Multiple_Perfect)
+
+        assign(headstone, perfect_indexes[0], 100)
+        return
+
+    match_df = get_fuzzy_matches(headstone, num_candidates)
+    store_candidates(headstone, match_df)
 
     # Empty data frame, no matches
     if match_df is None:
@@ -60,8 +105,6 @@ def driver_labeling(headstone):
     best_score = match_df.iloc[0]['Fuzziness']
     second_best_score = match_df.iloc[1]['Fuzziness']
     best_index = match_df.iloc[0].name
-    df_dict = dict(df.iloc[best_index])
-    label = global_vars.options["Label Format"].format(df_dict)
     
     # Perfect Match
     if best_score == 100:
@@ -70,18 +113,7 @@ def driver_labeling(headstone):
         if second_best_score == 100:
             raise exceptions.LabelError(exceptions.LabelError.Situations.Multiple_Perfect)
 
-        headstone.fuzziness_score = best_score
-        headstone.set_label(label)
-
-        # Entry already assigned, must reassign
-        if 0 < df.loc[best_index, 'Fuzziness'] < best_score:
-            df.loc[best_index, 'Fuzziness'] = best_score
-            reassign(best_index)
-
-        # No reassign needed
-        else:
-            df.loc[best_index, 'Fuzziness'] = best_score
-
+        assign(headstone, best_index, best_score)
         return
 
     # All matches below threshold (AKA: No Matches)
@@ -100,17 +132,105 @@ def driver_labeling(headstone):
         raise exceptions.LabelError(exceptions.LabelError.Situations.Fuzzy)
 
     # Driver IS permitted to approve fuzzy matches
-    headstone.fuzziness_score = best_score
-    headstone.set_label(label)
+    assign(headstone, best_index, best_score)
 
+
+# Label headstone with the entry at index
+# Must be called with the lock held
+def assign(headstone, index, score):
+    label = global_vars.options["Label Format"].format(dict(df.iloc[index]))
+    headstone.fuzziness_score = score
+    headstone.set_label(label)
+    set_entry_fuzziness(index, score)
+
+
+# A search of the data file for the user, from the fields they entered
+# Scores each field of every entry separately and remembers them, so changing one field only scores that field again
+# The ordered score is computed for every entry, from the field scores
+# The unordered score (the expensive one) only for the shortlist of entries with the best ordered scores,
+# so an entry outside the shortlist can't be found even if its unordered score would have ranked it in the top few
+class Search:
+    shortlist_size = 200
+
+    def __init__(self):
+        # Field -> (value searched, score of every entry, bonus of every entry)
+        self.field_scores = dict()
+
+    # Returns a pandas dataframe of the best num_matches entries for fields, like feedback_labeling
+    # Returns None if fields are all blank, or if cancelled() became True while searching
+    def run(self, fields, num_matches=5, cancelled=lambda: False):
+        guess = {k:fields[k] for k in Headstone.text_field_keys if k in search_columns and fields.get(k, "") != ""}
+        guess = normalize_dates(guess)
+        if len(guess) == 0:
+            return None
+
+        total_scores = np.zeros(len(dicts_df))
+        num_scores = np.full(len(dicts_df), float(len(guess)))
+        for k, value in guess.items():
+            if cancelled():
+                return None
+            scores, bonus = self.get_field_scores(k, value)
+            total_scores += scores + np.where(bonus, scores, 0)
+            num_scores += bonus
+
+        ordered = total_scores / num_scores
+        ordered[ordered < loaded_fuzziness] = 0
+
+        shortlist = np.argsort(-ordered, kind="stable")[:self.shortlist_size]
+        final_scores = list()
+        for i in shortlist:
+            if cancelled():
+                return None
+            unordered = get_fuzziness_score_one_entry_unordered(guess, dicts_df[i])
+            final_scores.append(round(0.1 * ordered[i] + 0.9 * unordered, 1))
+
+        best = sorted(range(len(shortlist)), key=lambda j: final_scores[j], reverse=True)[:num_matches]
+        return df.iloc[[shortlist[j] for j in best]].assign(Fuzziness = [final_scores[j] for j in best])
+
+    # Score of field against value for every entry, and whether each score earns the perfect match bonus
+    def get_field_scores(self, field, value):
+        if field in self.field_scores and self.field_scores[field][0] == value:
+            return self.field_scores[field][1:]
+
+        codes, values, lengths = search_columns[field]
+        scores = None
+        if field in date_parts:
+            scores = get_date_agreement(value, *date_parts[field])
+        if scores is None:
+            query = str(value).upper()
+            scores = np.array([fuzz.ratio(query, v) for v in values], dtype=float)[codes]
+
+        bonus = (scores == 100) & (lengths > 1) & (len(str(value)) > 1)
+        self.field_scores[field] = (value, scores, bonus)
+        return scores, bonus
+
+
+# Keep the best matches found for headstone with it, so feedback can show them without scoring every entry again
+def store_candidates(headstone, match_df):
+    headstone.candidates = None if match_df is None else match_df.to_dict(orient="records")
+    headstone.candidates_version = get_assignments_version()
+
+
+# Version of the assignments, to keep with candidates found now
+# Candidates stored in an earlier run never have the current version
+def get_assignments_version():
+    return (session_id, assignments_version)
+
+
+# Set the fuzziness score of the entry at index
+# If the entry was already assigned to an image with a lower score, that image is reassigned
+# Must be called with the lock held
+def set_entry_fuzziness(index, score):
+    global assignments_version
+    assignments_version += 1
     # Entry already assigned, must reassign
-    if 0 < df.loc[best_index, 'Fuzziness'] < best_score:
-        df.loc[best_index, 'Fuzziness'] = best_score
-        reassign(best_index)
+    if 0 < df.loc[index, 'Fuzziness'] < score:
+        df.loc[index, 'Fuzziness'] = score
+        reassign(index)
 
     # No reassign needed
     else:
-        df.loc[best_index, 'Fuzziness'] = best_score
+        df.loc[index, 'Fuzziness'] = score
 
 
 # Returns a pandas dataframe containing at most 5 records from the datafile, 
@@ -125,7 +245,32 @@ def feedback_labeling(headstone):
 # Sets the fuzziness score of an entry
 @locked
 def set_fuzziness(entry, score):
-    # First need to find the index (row name) of the entry in the dataframe
+    index = find_entry_index(entry)
+    if index is None:
+        return
+
+    # Once index is determined, just set the score
+    set_entry_fuzziness(index, score)
+
+
+# Sets the fuzziness score of several entries, holding the lock once for all of them
+# Entries already assigned (or not found) are left alone, so a batch never takes an entry from another image
+# Returns whether each entry was set
+@locked
+def set_fuzziness_batch(entries, score):
+    assigned = list()
+    for entry in entries:
+        index = find_entry_index(entry)
+        if index is None or df.loc[index, 'Fuzziness'] > 0:
+            assigned.append(False)
+        else:
+            set_entry_fuzziness(index, score)
+            assigned.append(True)
+    return assigned
+
+
+# Returns the index (row name) of the entry in the dataframe, or None if it isn't found exactly once
+def find_entry_index(entry):
     tempdf = df
     for k, v in entry.items():
         tempdf = tempdf[tempdf[k] == v]
@@ -133,20 +278,9 @@ def set_fuzziness(entry, score):
             break
 
     if len(tempdf) != 1:
-        return
-
-    index = tempdf.iloc[0].name
-
-    # Once index is determined, just set the score
-
-    # Entry already assigned, must reassign
-    if 0 < df.loc[index, 'Fuzziness'] < score:
-        df.loc[index, 'Fuzziness'] = score
-        reassign(index)
+        return None
 
-    # No reassign needed
-    else:
-        df.loc[index, 'Fuzziness'] = score
+    return tempdf.iloc[0].name
 
 
 # Calculate the fuzziness score of a headstone, based on its text fields, for each entry in the data file
@@ -161,9 +295,21 @@ def get_fuzzy_matches(headstone, num_matches=5):
     if len(fields) == 0:
         return None
 
-    dict_headstone = {k:headstone.text_fields[k] for k in fields}
+    dict_headstone = normalize_dates({k:headstone.text_fields[k] for k in fields})
 
-    fuzz_scores = [get_fuzziness_score_one_entry(dict_headstone, entry) for entry in dicts_df]
+    # Date agreement is scored for every entry at once
+    date_scores = dict()
+    for k in fields:
+        if k in date_parts:
+            scores = get_date_agreement(dict_headstone[k], *date_parts[k])
+            if scores is not None:
+                date_scores[k] = scores
+
+    if len(date_scores) == 0:
+        fuzz_scores = [get_fuzziness_score_one_entry(dict_headstone, entry) for entry in dicts_df]
+    else:
+        fuzz_scores = [get_fuzziness_score_one_entry(dict_headstone, entry, {k:v[i] for k, v in date_scores.items()})
+                       for i, entry in enumerate(dicts_df)]
 
     fields_and_scores = df.assign(Fuzziness = fuzz_scores)
     fields_and_scores = fields_and_scores.sort_values(by=["Fuzziness"], ascending=False)
@@ -173,6 +319,55 @@ def get_fuzzy_matches(headstone, num_matches=5):
 
 
 
+# Whether an image that couldn't be labeled in situation (a LabelError situation name) is queued for user feedback
+# Used both when the image is labeled and when the Feedback Folder is scanned again at start up
+def wants_feedback(situation):
+    situations = exceptions.LabelError.Situations
+    if global_vars.options["User Feedback"] == "Full" or situation == situations.Multiple_Perfect.name:
+        return True
+    return situation in (situations.Fuzzy.name, situations.Fuzzy_Tie.name, situations.Too_Close_To_Call.name) and \
+           global_vars.options["User Feedback"] != "Reject"
+
+
+# Dates in the data file are ISO (see load_data), so dates entered any other way (by the user) are converted before comparing
+def normalize_dates(fields):
+    return {k:(date_to_iso.date_to_iso(v) if k in date_columns and v != "" else v) for k, v in fields.items()}
+
+
+# Return the indexes of the entries the headstone matches perfectly (a fuzziness score of 100), using the exact match index
+# A perfect match has to agree exactly on every field, so it must share the headstone's key;
+# only the entries with that key are scored
+# Returns None if the headstone doesn't have every key field, so the index can't be used
+def get_exact_matches(headstone):
+    fields = get_evaluatable_fields(headstone)
+    if len(exact_index) == 0 or not all([k in fields for k in exact_key_fields]):
+        return None
+
+    dict_headstone = normalize_dates({k:headstone.text_fields[k] for k in fields})
+    candidates = exact_index.get(get_exact_key(dict_headstone), [])
+
+    perfect_indexes = list()
+    for i in candidates:
+        date_scores = dict()
+        for k in fields:
+            if k in date_parts:
+                scores = get_date_agreement(dict_headstone[k], *[parts[i:i+1] for parts in date_parts[k]])
+                if scores is not None:
+                    date_scores[k] = scores[0]
+
+        if get_fuzziness_score_one_entry(dict_headstone, dicts_df[i], date_scores) == 100:
+            perfect_indexes.append(i)
+
+    return perfect_indexes
+
+
+# Key of the exact match index for a headstone's fields or a data file entry
+# Names are compared in upper case, like the fuzz ratios; dates by their parts, like the date agreement
+def get_exact_key(fields):
+    surname, first_name, death_date = [fields[k] for k in exact_key_fields]
+    return (str(surname).upper(), str(first_name).upper(), parse_iso(death_date))
+
+
 # Return a list of the columns of the data file,
 # that have a corresponding field of the headstone
 # for which we have data 
@@ -193,14 +388,18 @@ def get_evaluatable_fields(headstone):
 #   the entry must already be in use by something better; therefore, return 0
 # guess: an OrderedDict of the fields on the headstone
 # entry: an OrderedDict of the fields in a data file entry
+# date_scores: a dict of precomputed scores for the date fields (see get_date_agreement), used instead of the fuzz ratio
 # Precondition: entry has all the same keys as guess, and potentially more
 # Returns the fuzz ratio for guess and entry
-def get_fuzziness_score_one_entry_ordered(guess, entry):
+def get_fuzziness_score_one_entry_ordered(guess, entry, date_scores={}):
     #field_scores = list()
     total_score = 0
     num_scores = len(guess.keys())
     for k in guess.keys():
-        score = fuzz.ratio(str(guess[k]).upper(), str(entry[k]).upper())
+        if k in date_scores:
+            score = date_scores[k]
+        else:
+            score = fuzz.ratio(str(guess[k]).upper(), str(entry[k]).upper())
         #field_scores.append(score)
         total_score += score
         if score == 100 and len(str(guess[k])) > 1 and len(str(entry[k])) > 1:
@@ -225,16 +424,57 @@ def get_fuzziness_score_one_entry_unordered(guess, entry):
     return score 
 
 
-def get_fuzziness_score_one_entry(guess, entry):
-    ordered = get_fuzziness_score_one_entry_ordered(guess, entry)
+def get_fuzziness_score_one_entry(guess, entry, date_scores={}):
+    ordered = get_fuzziness_score_one_entry_ordered(guess, entry, date_scores)
     unordered = get_fuzziness_score_one_entry_unordered(guess, entry)
     score = 0.1 * ordered + 0.9 * unordered
     return round(score, 1)
 
 
+# Split an ISO date ("1862-06-04", or partial like "1862--") into integer year, month and day, with 0 for missing parts
+def parse_iso(date):
+    parts = str(date).split('-')
+    if len(parts) != 3:
+        return 0, 0, 0
+
+    year, month, day = [int(part) if part.isdigit() else 0 for part in parts]
+    if not 0 < month < 13:
+        month = 0
+    if not 0 < day < 32:
+        day = 0
+    return year, month, day
+
+
+# Score from 0 to 100 of how well an ISO date agrees with the date of every entry, as an array
+# Years and days score by how many of their digits agree (OCR usually misreads single digits), months must be equal
+# The year counts double; a part only one of the dates has counts as a disagreement
+# Returns None if guess has no parts to compare
+def get_date_agreement(guess, years, months, days):
+    guess_parts = parse_iso(guess)
+    if guess_parts == (0, 0, 0):
+        return None
+
+    score = np.zeros(len(years))
+    weight = np.zeros(len(years))
+    for guess_part, values, part_weight, num_digits in zip(guess_parts, (years, months, days), (2, 1, 1), (4, None, 2)):
+        present = values > 0
+        if guess_part > 0:
+            weight += part_weight
+            if num_digits is None:
+                agreement = (values == guess_part).astype(float)
+            else:
+                agreement = sum([(values // 10**i) % 10 == (guess_part // 10**i) % 10 for i in range(num_digits)]) / num_digits
+            score += part_weight * np.where(present, agreement, 0.0)
+        else:
+            weight += part_weight * present
+
+    return 100 * score / np.maximum(weight, 1)
+
+
 # Reassign the image currently assigned to the entry located at 'index' to a different entry
 @unlocked
 def reassign(index):
+    metrics.count("Reassignments")
     entry_dict = dict(df.iloc[index])
     label = global_vars.options["Label Format"].format(entry_dict)
     path = global_vars.parameters["Destination Folder"] + slash + label + '.JPG'
@@ -243,7 +483,7 @@ def reassign(index):
         driver_labeling(headstone)
     except exceptions.LabelError as e:
         headstone.error = e
-        headstone.log_event("Encountered exception '{}' during reassignment".format(str(e)))
+        headstone.log_event("Encountered exception '{}' during reassignment".format(str(e)), stage="Reassign")
         headstone.label = Headstone.extract_filename(headstone.original_path)[1:]
         headstone.move("Feedback Folder", target="MODIFIED", apply_label=True)
         headstone.label = None
@@ -251,7 +491,7 @@ def reassign(index):
         global_vars.feedback_queue.append(headstone.modified_path)
     else:
         headstone.error = None
-        headstone.log_event("Reassigned successfully with label '{}'".format(headstone.label))
+        headstone.log_event("Reassigned successfully with label '{}'".format(headstone.label), stage="Reassign")
         headstone.move("Destination Folder", target="MODIFIED", apply_label=True)
         headstone.save()
 
@@ -259,7 +499,6 @@ def reassign(index):
 
 # Load the data from the data file into the global df variable
 # Does nothing if it's already loaded
-# Also load the global log
 @locked
 def load_data():
     global df
@@ -270,23 +509,41 @@ def load_data():
         df = df.replace(np.nan, '', regex=True)
         if 'Fuzziness' not in df.columns:
             df = df.assign(Fuzziness = [0] * len(df))
+        # Scores have a decimal place
+        df['Fuzziness'] = pd.to_numeric(df['Fuzziness'], errors='coerce').fillna(0.0).astype(float)
     if dicts_df is None:
         dicts_df = dicts_df = df.to_dict(orient="records")
-    
-    try:
-        with open(global_vars.parameters["Log File"], 'r') as f:
-            old_log = f.read()
-        if old_log != '':
-            logs = [log for log in old_log.split('\n') if log != '']
-            last_log = logs[-1] if len(logs) > 0 else ''
-            global_vars.prev_log = last_log.split('\t')[0]
-    except FileNotFoundError as e:
-        pass
+
+        # Dates are normalized to ISO once, for scoring; the data file itself keeps its own format
+        date_parts.clear()
+        for k in date_columns:
+            if k in df.columns:
+                dates = date_to_iso.dates_to_iso(df[k])
+                for entry, date in zip(dicts_df, dates):
+                    entry[k] = date
+                parts = np.array([parse_iso(date) for date in dates], dtype=int).reshape(-1, 3)
+                date_parts[k] = (parts[:, 0], parts[:, 1], parts[:, 2])
+
+        exact_index.clear()
+        if all([k in df.columns for k in exact_key_fields]):
+            for i, entry in enumerate(dicts_df):
+                exact_index.setdefault(get_exact_key(entry), list()).append(i)
+
+        # Distinct values are only scored once per search
+        search_columns.clear()
+        for k in Headstone.text_field_keys:
+            if k in df.columns:
+                codes, values = pd.factorize(pd.Series([str(entry[k]).upper() for entry in dicts_df], dtype=object))
+                lengths = np.array([len(str(entry[k])) for entry in dicts_df])
+                search_columns[k] = (codes, list(values), lengths)
+
+        global loaded_fuzziness
+        loaded_fuzziness = np.array([entry['Fuzziness'] for entry in dicts_df], dtype=float)
 
 
 # Save the data back into the CSV
 # important for the fuzziness data
-# Also save the global log
+# Also write out the rest of the event log
 @locked
 def write_data():
     global df
@@ -296,7 +553,6 @@ def write_data():
             os.remove(data_file)
         df.to_csv(data_file, index=False)
 
-    with open(global_vars.parameters["Log File"], 'a') as f:
-        f.write(global_vars.log)
+    event_log.close()
 
 
@@ -6,17 +6,22 @@ import textRec
 import textRecCloud
 import cv2
 from PIL import Image
+import metrics
 
 def OCR(image, isOnline):
 
     OCR_output = []
 
     #Run both the text detection and text recognition
-    num = textDetect.OCR(image)
-    if isOnline is True:
-        OCR_output = textRecCloud.Rec()
-    else:
-        OCR_output = textRec.Rec()
+    with metrics.stage("Detect"):
+        num = textDetect.OCR(image)
+    metrics.count("Text Crops", num)
+
+    with metrics.stage("Recognize"):
+        if isOnline is True:
+            OCR_output = textRecCloud.Rec()
+        else:
+            OCR_output = textRec.Rec()
 
     shutil.rmtree('output')
 
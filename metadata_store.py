@@ -0,0 +1,149 @@
+# Headstone Photograph Processing System
+# Metadata Store
+# Holds the saved metadata (the pickled Headstone) of every image processed, in one SQLite file in the Working Folder
+#
+# Rows are keyed by image id (unique to every image processed, see Headstone.image_id) and indexed by the current paths
+# of the original and modified images,
+# so a headstone can be loaded from the path of either image wherever it has been moved
+# The original filename, situation, fuzziness score and label are also kept as columns, so they can be read without unpickling
+#
+# The database is in WAL mode and saves are committed in batches: every batch_size saves or commit_interval seconds,
+# whichever comes first (and when the store is committed or closed)
+
+import atexit
+import sqlite3
+import threading
+import time
+
+from global_vars import global_vars, slash
+
+store_filename = ".metadata.sqlite"
+
+# Saves committed together in one transaction
+batch_size = 50
+
+# Most seconds a save waits to be committed
+commit_interval = 1.0
+
+store = None
+
+# Held while the store is opened or closed, so threads using it first never open it twice
+open_lock = threading.Lock()
+
+
+class Metadata_Store:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS headstones (
+                                       id TEXT PRIMARY KEY,
+                                       original_filename TEXT,
+                                       original_path TEXT,
+                                       modified_path TEXT,
+                                       situation TEXT,
+                                       fuzziness_score REAL,
+                                       label TEXT,
+                                       data BLOB,
+                                       updated REAL)""")
+        # Stores made before image ids were keyed by the original filename, and had no column for it
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(headstones)")]
+        if "original_filename" not in columns:
+            self.connection.execute("ALTER TABLE headstones ADD COLUMN original_filename TEXT")
+            self.connection.execute("UPDATE headstones SET original_filename = id")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS headstones_original_path ON headstones (original_path)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS headstones_modified_path ON headstones (modified_path)")
+        self.connection.commit()
+
+        self.num_pending = 0
+        self.stopping = threading.Event()
+        self.committer = threading.Thread(target=self.commit_loop, name="Metadata Store", daemon=True)
+        self.committer.start()
+
+    # Insert or replace the row of image id
+    # The write is visible to get() straight away, but only committed with the rest of its batch
+    def put(self, id, original_filename, original_path, modified_path, situation, fuzziness_score, label, data):
+        with self.lock:
+            self.connection.execute("REPLACE INTO headstones (id, original_filename, original_path, modified_path, situation, "
+                                    "fuzziness_score, label, data, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (id, original_filename, original_path, modified_path, situation, fuzziness_score, label, data, time.time()))
+            self.num_pending += 1
+            if self.num_pending >= batch_size:
+                self.commit_locked()
+
+    # Returns the saved data of the headstone with an image at path, or None if there is none
+    def get(self, path):
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM headstones WHERE modified_path = ? OR original_path = ? ORDER BY updated DESC LIMIT 1",
+                                          (path, path)).fetchone()
+        return None if row is None else row[0]
+
+    # Returns (modified path, situation) of every headstone whose modified image is in folder, without unpickling any of them
+    def get_situations(self, folder):
+        prefix = folder + slash
+        with self.lock:
+            return self.connection.execute("SELECT modified_path, situation FROM headstones WHERE modified_path >= ? AND modified_path < ?",
+                                           (prefix, prefix + '\uffff')).fetchall()
+
+    def commit(self):
+        with self.lock:
+            self.commit_locked()
+
+    # Must be called with the lock held
+    def commit_locked(self):
+        if self.num_pending > 0:
+            self.connection.commit()
+            self.num_pending = 0
+
+    def commit_loop(self):
+        while not self.stopping.wait(commit_interval):
+            self.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM headstones")
+            self.connection.commit()
+            self.num_pending = 0
+
+    def close(self):
+        self.stopping.set()
+        self.committer.join()
+        with self.lock:
+            self.commit_locked()
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM headstones").fetchone()[0]
+
+
+def store_path():
+    return global_vars.parameters["Working Folder"] + slash + store_filename
+
+
+# Open the store in the Working Folder
+# Does nothing if it's already open
+def open_store():
+    global store
+    with open_lock:
+        if store is None:
+            store = Metadata_Store(store_path())
+        return store
+
+
+def commit():
+    if store is not None:
+        store.commit()
+
+
+def close():
+    global store
+    with open_lock:
+        if store is not None:
+            store.close()
+            store = None
+
+
+# Don't lose the last batch if the program exits without closing the store
+atexit.register(close)
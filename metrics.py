@@ -0,0 +1,314 @@
+# Headstone Photograph Processing System
+# Runtime Metrics
+# Per-stage timers and counters, recorded separately for every image processed
+#
+# The driver calls begin_image() before an image and end_image() after it
+# In between, any code can time itself with "with metrics.stage(name):" or count events with metrics.count(name)
+# Stages may be nested; each stage only records its own time, not the time of the stages inside it
+#
+# Records can be written to a file as JSON lines (one per image) and are summarized (p50/p95/p99) at the end of the run
+# Only the most recent max_records are kept in memory (a watched folder can run forever); the running totals and the
+# JSON lines file cover the whole run
+# While the run is going, live_stats() gives a thread-safe snapshot of throughput, recent stage latencies,
+# the stage each thread is currently in and any registered gauges (queue lengths, etc.), for the user interface
+
+import collections
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+stages = ("Decode", "Macro Rotate", "Micro Rotate", "Crop", "Detect", "Recognize", "Categorize", "Label", "Write")
+counters = ("Text Crops", "Tesseract Calls", "Reassignments", "Cache Hits")
+
+# JSON lines file every finished record is appended to, or None to keep records in memory only
+output_file = None
+
+# Most records kept in memory, for summary()
+max_records = 10000
+
+records = collections.deque(maxlen=max_records)
+records_lock = threading.Lock()
+local = threading.local()
+
+# The most recent records, used for live statistics
+recent = collections.deque(maxlen=50)
+
+# Thread name -> (stage name, start time) of the stage each thread is currently in
+active_stages = dict()
+
+# Gauge name -> function returning the gauge's current value
+gauges = collections.OrderedDict()
+
+# Histogram bucket upper bounds, in seconds
+histogram_buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def new_histogram():
+    return {"Buckets": [0] * len(histogram_buckets), "Sum": 0.0, "Count": 0}
+
+
+def observe(histogram, value):
+    for i, bound in enumerate(histogram_buckets):
+        if value <= bound:
+            histogram["Buckets"][i] += 1
+    histogram["Sum"] += value
+    histogram["Count"] += 1
+
+
+# Running totals over the whole run, kept up to date as records finish (for the metrics exporter)
+#   Total: histogram of the time per image
+#   Stages: stage name -> histogram of the time per image spent in that stage
+#   Counters: counter name -> total over every image
+#   Errors: (exception type, situation) -> number of images that ended with that error
+totals = {"Total": new_histogram(), "Stages": dict(), "Counters": dict(), "Errors": dict()}
+
+# Model name -> seconds it took to load
+model_load_times = collections.OrderedDict()
+
+# Objects told when this thread's images and stages start and end (the profiler, see profiling.py)
+# Each has begin_image(name), end_image(), enter_stage(name) and exit_stage(name) methods
+observers = list()
+
+
+# Start a new record for the image being processed by this thread
+def begin_image(name):
+    local.record = {
+        "Image": name,
+        "Start": time.time(),
+        "Total": 0.0,
+        "Stages": dict(),
+        "Counters": dict()
+    }
+    local.stack = list()
+    local.started = time.perf_counter()
+
+    for observer in observers:
+        observer.begin_image(name)
+
+
+# Finish this thread's record, store it, and return it
+def end_image():
+    record = getattr(local, "record", None)
+    if record is None:
+        return None
+
+    record["Total"] = time.perf_counter() - local.started
+    record["End"] = time.time()
+    local.record = None
+
+    for observer in observers:
+        observer.end_image()
+
+    with records_lock:
+        records.append(record)
+        recent.append(record)
+
+        observe(totals["Total"], record["Total"])
+        for k, v in record["Stages"].items():
+            if k not in totals["Stages"]:
+                totals["Stages"][k] = new_histogram()
+            observe(totals["Stages"][k], v)
+        for k, v in record["Counters"].items():
+            totals["Counters"][k] = totals["Counters"].get(k, 0) + v
+
+        if output_file is not None:
+            with open(output_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    return record
+
+
+# Time the code inside the with block as part of stage name
+@contextmanager
+def stage(name):
+    stack = getattr(local, "stack", None)
+    if stack is None:
+        stack = local.stack = list()
+
+    # Each frame is [stage name, time spent in stages nested inside it, wall clock start time]
+    frame = [name, 0.0, time.time()]
+    stack.append(frame)
+    thread_name = threading.current_thread().name
+    active_stages[thread_name] = (name, frame[2])
+    for observer in observers:
+        observer.enter_stage(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for observer in observers:
+            observer.exit_stage(name)
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1][1] += elapsed
+            active_stages[thread_name] = (stack[-1][0], stack[-1][2])
+        else:
+            active_stages.pop(thread_name, None)
+
+        record = getattr(local, "record", None)
+        if record is not None:
+            record["Stages"][name] = record["Stages"].get(name, 0.0) + elapsed - frame[1]
+
+
+# Decorator to time every call of a function as part of stage name
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return inner
+    return decorator
+
+
+# Time the loading of a model
+# Counts as the "Model Load" stage, and is remembered in model_load_times
+@contextmanager
+def model_load(name):
+    start = time.perf_counter()
+    with stage("Model Load"):
+        yield
+    model_load_times[name] = time.perf_counter() - start
+
+
+# Count an image that ended with error (an exception)
+# LabelErrors are counted separately for each situation
+def record_error(error):
+    situation = getattr(error, "situation", None)
+    key = (type(error).__name__, "" if situation is None else situation.name)
+    with records_lock:
+        totals["Errors"][key] = totals["Errors"].get(key, 0) + 1
+
+
+# Name of the innermost stage this thread is in, or None
+def current_stage():
+    stack = getattr(local, "stack", None)
+    if not stack:
+        return None
+    return stack[-1][0]
+
+
+# Total time this thread's record has spent in the named stages so far, or None if it hasn't been in any of them
+def stage_time(*names):
+    record = getattr(local, "record", None)
+    if record is None or not any([name in record["Stages"] for name in names]):
+        return None
+    return sum([record["Stages"].get(name, 0.0) for name in names])
+
+
+# Add n to the counter name of this thread's record
+def count(name, n=1):
+    record = getattr(local, "record", None)
+    if record is not None:
+        record["Counters"][name] = record["Counters"].get(name, 0) + n
+
+
+# Make func's value available in live_stats under name
+def register_gauge(name, func):
+    gauges[name] = func
+
+
+# Snapshot of the run so far, safe to call from any thread:
+#   Images: number of images finished
+#   Images Per Minute: throughput over the recent images
+#   Utilization: fraction of the recent wall time the processing threads were busy with images
+#   Stage Latency: mean time of each stage over the recent images
+#   Since Last Image: seconds since the last image finished
+#   Active Stages: thread name -> (stage name, seconds in that stage so far)
+#   Gauges: gauge name -> current value
+def live_stats():
+    with records_lock:
+        window = list(recent)
+        num_images = totals["Total"]["Count"]
+
+    now = time.time()
+    stats = {
+        "Images": num_images,
+        "Images Per Minute": 0.0,
+        "Utilization": 0.0,
+        "Stage Latency": collections.OrderedDict(),
+        "Since Last Image": None,
+        "Active Stages": {k: (v[0], now - v[1]) for k, v in list(active_stages.items())},
+        "Gauges": collections.OrderedDict()
+    }
+
+    if len(window) > 0:
+        elapsed = max(now - window[0]["Start"], 1e-6)
+        stats["Images Per Minute"] = 60 * len(window) / elapsed
+        stats["Utilization"] = min(sum([r["Total"] for r in window]) / elapsed, 1.0)
+        stats["Since Last Image"] = now - window[-1]["End"]
+        for k in stages:
+            stats["Stage Latency"][k] = sum([r["Stages"].get(k, 0.0) for r in window]) / len(window)
+
+    for name, func in list(gauges.items()):
+        try:
+            stats["Gauges"][name] = func()
+        except Exception:
+            stats["Gauges"][name] = None
+
+    return stats
+
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    index = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+# Summarize a list of values as count, mean, p50, p95, p99 and max
+def summarize(values):
+    values = sorted(values)
+    return {
+        "Count": len(values),
+        "Mean": sum(values) / len(values) if len(values) > 0 else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "Max": values[-1] if len(values) > 0 else 0.0
+    }
+
+
+# Summary of every stage, counter and the total time per image, over the given records
+# (by default the records still in memory: the last max_records images)
+# Images that never reached a stage count as 0 for that stage
+def summary(selected=None):
+    if selected is None:
+        with records_lock:
+            selected = list(records)
+
+    stage_names = list(stages) + sorted({k for r in selected for k in r["Stages"]} - set(stages))
+    counter_names = list(counters) + sorted({k for r in selected for k in r["Counters"]} - set(counters))
+
+    return {
+        "Images": len(selected),
+        "Total": summarize([r["Total"] for r in selected]),
+        "Stages": {k: summarize([r["Stages"].get(k, 0.0) for r in selected]) for k in stage_names},
+        "Counters": {k: summarize([r["Counters"].get(k, 0) for r in selected]) for k in counter_names}
+    }
+
+
+# Human readable table of a summary
+def format_summary(result):
+    lines = ["Images processed: {}".format(result["Images"])]
+    lines.append("".ljust(18) + "".join([k.rjust(10) for k in ("Mean", "p50", "p95", "p99", "Max")]))
+
+    rows = [("Total (s)", result["Total"])]
+    rows += [(k + " (s)", v) for k, v in result["Stages"].items()]
+    rows += [(k, v) for k, v in result["Counters"].items()]
+
+    for name, values in rows:
+        lines.append(name.ljust(18) + "".join([f"{values[k]:10.3f}" for k in ("Mean", "p50", "p95", "p99", "Max")]))
+
+    return '\n'.join(lines)
+
+
+# Read records back from a JSON lines file written during a run
+def load_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip() != '']
@@ -0,0 +1,163 @@
+# Headstone Photograph Processing System
+# Metrics Exporter
+# Serves the runtime metrics over HTTP in the Prometheus text format, so long batch runs can be monitored remotely
+#
+# Off by default; set "Metrics Port" in the settings file to a port number to turn it on
+# The endpoint only listens on this machine (127.0.0.1) and serves:
+#   http://127.0.0.1:<port>/metrics
+#
+# Exposed metrics:
+#   headstone_images_processed_total: images finished
+#   headstone_image_seconds: histogram of the time per image
+#   headstone_stage_seconds{stage}: histogram of the time per image spent in each stage
+#   headstone_events_total{counter}: totals of the per-image counters (Tesseract calls, cache hits, etc.)
+#   headstone_errors_total{type, situation}: images that ended with an error, by exception type (and labeling situation)
+#   headstone_queue_length{queue}: current length of each registered queue (the feedback queue, etc.)
+#   headstone_model_load_seconds{model}: time it took to load each model
+#
+# To see what a scrape looks like without running the system:
+#   python metrics_exporter.py [port]
+
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+
+address = "127.0.0.1"
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+server = None
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(['{}="{}"'.format(k, escape(v)) for k, v in labels]) + "}"
+
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    return repr(float(value))
+
+
+def header(lines, name, metric_type, help_text):
+    lines.append("# HELP {} {}".format(name, help_text))
+    lines.append("# TYPE {} {}".format(name, metric_type))
+
+
+def histogram_lines(lines, name, histogram, labels=()):
+    labels = list(labels)
+    for bound, count in zip(metrics.histogram_buckets, histogram["Buckets"]):
+        lines.append("{}_bucket{} {}".format(name, format_labels(labels + [("le", repr(float(bound)))]), count))
+    lines.append("{}_bucket{} {}".format(name, format_labels(labels + [("le", "+Inf")]), histogram["Count"]))
+    lines.append("{}_sum{} {}".format(name, format_labels(labels), format_value(histogram["Sum"])))
+    lines.append("{}_count{} {}".format(name, format_labels(labels), histogram["Count"]))
+
+
+# The current metrics, in the Prometheus text format
+def render():
+    with metrics.records_lock:
+        num_images = metrics.totals["Total"]["Count"]
+        total = {"Buckets": list(metrics.totals["Total"]["Buckets"]), "Sum": metrics.totals["Total"]["Sum"], "Count": metrics.totals["Total"]["Count"]}
+        stages = {k: {"Buckets": list(v["Buckets"]), "Sum": v["Sum"], "Count": v["Count"]} for k, v in metrics.totals["Stages"].items()}
+        counters = dict(metrics.totals["Counters"])
+        errors = dict(metrics.totals["Errors"])
+    gauges = metrics.live_stats()["Gauges"]
+    model_load_times = list(metrics.model_load_times.items())
+
+    lines = list()
+
+    header(lines, "headstone_images_processed_total", "counter", "Images finished")
+    lines.append("headstone_images_processed_total {}".format(num_images))
+
+    header(lines, "headstone_image_seconds", "histogram", "Time to process one image")
+    histogram_lines(lines, "headstone_image_seconds", total)
+
+    header(lines, "headstone_stage_seconds", "histogram", "Time per image spent in each stage")
+    stage_names = list(metrics.stages) + sorted(set(stages) - set(metrics.stages))
+    for k in stage_names:
+        if k in stages:
+            histogram_lines(lines, "headstone_stage_seconds", stages[k], [("stage", k)])
+
+    header(lines, "headstone_events_total", "counter", "Totals of the per-image counters")
+    counter_names = list(metrics.counters) + sorted(set(counters) - set(metrics.counters))
+    for k in counter_names:
+        lines.append("headstone_events_total{} {}".format(format_labels([("counter", k)]), counters.get(k, 0)))
+
+    header(lines, "headstone_errors_total", "counter", "Images that ended with an error")
+    for (error_type, situation), count in sorted(errors.items()):
+        lines.append("headstone_errors_total{} {}".format(format_labels([("type", error_type), ("situation", situation)]), count))
+
+    header(lines, "headstone_queue_length", "gauge", "Current length of each queue")
+    for k, v in gauges.items():
+        lines.append("headstone_queue_length{} {}".format(format_labels([("queue", k)]), format_value(v)))
+
+    header(lines, "headstone_model_load_seconds", "gauge", "Time it took to load each model")
+    for k, v in model_load_times:
+        lines.append("headstone_model_load_seconds{} {}".format(format_labels([("model", k)]), format_value(v)))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics_Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are frequent; don't print a line for every one
+    def log_message(self, format, *args):
+        pass
+
+
+# Start serving the metrics on port in a background thread
+# Does nothing if the exporter is already running
+def start(port):
+    global server
+    if server is not None:
+        return server
+
+    server = ThreadingHTTPServer((address, port), Metrics_Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics Exporter", daemon=True).start()
+    return server
+
+
+def stop():
+    global server
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        server = None
+
+
+if __name__ == "__main__":
+    import urllib.request
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+
+    # One made up image, so every metric has something to show
+    metrics.register_gauge("Feedback", lambda: 0)
+    metrics.begin_image("example.JPG")
+    with metrics.stage("Decode"):
+        pass
+    metrics.count("Tesseract Calls", 3)
+    metrics.end_image()
+
+    port = start(port).server_address[1]
+    with urllib.request.urlopen("http://{}:{}/metrics".format(address, port)) as response:
+        print(response.read().decode())
+    stop()
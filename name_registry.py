@@ -0,0 +1,77 @@
+# Headstone Photograph Processing System
+# Name Registry
+# Hands out free filenames in the output folders, so images with the same label never overwrite each other
+#
+# Each folder's registry is seeded by scanning the folder once; after that, names are reserved in memory
+# If a name is taken, " (1)", " (2)", ... is added before the extension, continuing from the last suffix used for that name
+# Reserving is atomic, so parallel workers never get the same name
+# As a safeguard against files added from outside the system, the chosen name is still checked on disk (one check per reservation)
+
+import os
+import threading
+
+lock = threading.Lock()
+
+# Folder -> its registry
+registries = dict()
+
+
+class Name_Registry:
+    def __init__(self, folder):
+        self.folder = folder
+        self.names = {os.path.normcase(name) for name in os.listdir(folder)} if os.path.isdir(folder) else set()
+
+        # Name without extension -> last suffix tried for it
+        self.last_suffix = dict()
+
+    # Reserve filename, or the first free name with a suffix
+    # Must be called with the lock held
+    def reserve(self, filename):
+        base, extension = os.path.splitext(filename)
+        candidate = filename
+        i = self.last_suffix.get(base, 0)
+
+        while os.path.normcase(candidate) in self.names or os.path.exists(os.path.join(self.folder, candidate)):
+            self.names.add(os.path.normcase(candidate))
+            i += 1
+            candidate = base + f" ({i})" + extension
+
+        if i > 0:
+            self.last_suffix[base] = i
+        self.names.add(os.path.normcase(candidate))
+        return candidate
+
+    # Must be called with the lock held
+    def release(self, filename):
+        self.names.discard(os.path.normcase(filename))
+
+
+def get_registry(folder):
+    folder = os.path.normcase(os.path.abspath(folder))
+    if folder not in registries:
+        registries[folder] = Name_Registry(folder)
+    return registries[folder]
+
+
+# Reserve path, or the first free path with a suffix in the same folder, and return it
+def reserve(path):
+    folder, filename = os.path.split(path)
+    with lock:
+        filename = get_registry(folder).reserve(filename)
+    return os.path.join(folder, filename)
+
+
+# Free path's name after the file has been moved or removed
+# Folders that never had a name reserved aren't tracked, so there is nothing to free
+def release(path):
+    folder, filename = os.path.split(path)
+    folder = os.path.normcase(os.path.abspath(folder))
+    with lock:
+        if folder in registries:
+            registries[folder].release(filename)
+
+
+# Forget every registry, so folders are scanned again when next used
+def reset():
+    with lock:
+        registries.clear()
@@ -1,6 +1,7 @@
 import tkinter as tk
 import color_palette
 import global_vars
+import metrics
 from feedback import Feedback_Screen
 
 color = color_palette.color_pallette
@@ -33,6 +34,48 @@ class Progress_Label(tk.Frame):
         self.label.config(text="Done")
 
 
+# Live statistics on the run: throughput, ETA, the stage currently running, queue depths and recent stage latencies
+# Everything shown comes from metrics.live_stats(), so it can be refreshed from the Tk thread while the driver runs
+class Stats_Panel(tk.Frame):
+    def __init__(self, master):
+        super().__init__(master, bg=color.bg)
+        self.pack(padx=20, pady=(15, 0))
+
+        self.label = tk.Label(self, bg=color.bg, fg=color.fg, padx=10, justify="left", font="Courier 10")
+        self.label.pack(side="left")
+
+    # Format a number of seconds as h:mm:ss
+    @staticmethod
+    def format_duration(seconds):
+        seconds = int(seconds)
+        return "{}:{:02}:{:02}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    def update(self):
+        stats = metrics.live_stats()
+        lines = list()
+
+        rate = stats["Images Per Minute"]
+        remaining = max(global_vars.num_images - stats["Images"], 0)
+        eta = self.format_duration(60 * remaining / rate) if rate > 0 else "--"
+        lines.append("Throughput:  {:.1f} images/min    ETA: {}    Busy: {:.0%}".format(rate, eta, stats["Utilization"]))
+
+        for thread_name, (stage, seconds) in stats["Active Stages"].items():
+            lines.append("Running:     {} ({:.1f} s) [{}]".format(stage, seconds, thread_name))
+        if stats["Since Last Image"] is not None:
+            lines.append("Last image finished {:.1f} s ago".format(stats["Since Last Image"]))
+
+        if len(stats["Gauges"]) > 0:
+            lines.append("Queues:      " + "    ".join(["{} {}".format(k, v) for k, v in stats["Gauges"].items()]))
+
+        if len(stats["Stage Latency"]) > 0:
+            lines.append("Stage latency over the last {} images (s):".format(len(metrics.recent)))
+            latencies = ["{} {:.2f}".format(k, v) for k, v in stats["Stage Latency"].items()]
+            for i in range(0, len(latencies), 5):
+                lines.append("    " + "    ".join(latencies[i:i+5]))
+
+        self.label.config(text='\n'.join(lines))
+
+
 # Informs user of the number of images waiting for user feedback
 class Feedback_Queue_Label(tk.Frame):
     def __init__(self, master):
@@ -97,7 +140,10 @@ class Abort_Button(tk.Frame):
 # Displays to the user the current progress on processing the images and
 # the number of images waiting for user feedback (if feedback is enabled)
 # User can switch into feedback mode, or abort the program altogether
+# The driver thread never touches the widgets: they are refreshed from the Tk thread by an after() timer
 class Processing_Screen(tk.Frame):
+    refresh_interval = 1000
+
     def __init__(self, master):
         super().__init__(master, bg=color.bg)
         self.master = master
@@ -107,6 +153,7 @@ class Processing_Screen(tk.Frame):
         self.state = "Running"
 
         self.progress_label = Progress_Label(self)
+        self.stats_panel = Stats_Panel(self)
 
         if global_vars.options["User Feedback"] != "None":
             self.feedback_queue_label = Feedback_Queue_Label(self)
@@ -115,6 +162,14 @@ class Processing_Screen(tk.Frame):
         self.abort_button = Abort_Button(self, self.abort, self.close)
 
         self.update()
+        self.refresh_id = self.after(Processing_Screen.refresh_interval, self.refresh)
+
+
+    # Periodically refresh the widgets, on the Tk thread
+    def refresh(self):
+        self.update()
+        self.stats_panel.update()
+        self.refresh_id = self.after(Processing_Screen.refresh_interval, self.refresh)
 
 
     # Changes the appearance of the interface so the user knows the system is aborting
@@ -125,16 +180,22 @@ class Processing_Screen(tk.Frame):
             self.abort_button.abort()
 
 
-    # Changes the appearance of the interface so the user knows the system has finished processing
+    # Called by the driver when it has finished processing
+    # The interface shows it on its next refresh
     def done(self):
         self.state = "Done"
-        self.progress_label.done()
-        self.abort_button.done()
+
+
+    # Called by the driver before each image
+    # Returns True if the program is aborting, so the driver knows not to process another image
+    def is_aborting(self):
+        return self.state == "Aborting"
         
 
     # Closes the user interface
     def close(self):
         if self.state == "Done":
+            self.after_cancel(self.refresh_id)
             self.feedback_screen.destroy()
             self.destroy()
             self.master.destroy()
@@ -147,13 +208,18 @@ class Processing_Screen(tk.Frame):
         self.feedback_screen.pack(fill="both", expand=True)
 
 
-    # Called by the driver to update the progress
-    # Returns True if the program is aborting, so the driver knows not to process another image
+    # Update the progress shown to the user
+    # Returns True if the program is aborting
     def update(self):
         if self.state == "Aborting":
             return True
 
-        self.progress_label.update()
+        # Changes the appearance of the interface so the user knows the system has finished processing
+        if self.state == "Done":
+            self.progress_label.done()
+            self.abort_button.done()
+        else:
+            self.progress_label.update()
 
         if global_vars.options["User Feedback"] != "None":
             self.feedback_queue_label.update()
@@ -0,0 +1,273 @@
+# Headstone Photograph Processing System
+# Profiling
+# Profiles the system while it runs: the whole of each image or only chosen stages, for every image or only every Nth one
+#
+# Set in the settings file:
+#   > Profiling: Off, cProfile or Sampling
+#       cProfile is deterministic (exact call counts), but slows down everything it profiles
+#       Sampling looks at the profiled thread's stack every few milliseconds; its overhead is low enough for production runs
+#       Either way, only the threads processing images (the driver) are profiled; background threads such as the image writer,
+#       thumbnail prefetch and metadata store committer are not (except from Python 3.12, where cProfile sees every thread
+#       while it's enabled)
+#   > Profiling Stages: Comma separated names of the stages to profile (see metrics.stages), or nothing for the whole image
+#   > Profile Every: Profile one image out of every this many
+#
+# Written when processing finishes:
+#   profiling_output.prof: pstats file (cProfile only)
+#   profiling_output.folded: collapsed stacks, one "frame;frame;...;frame weight" line per stack, for flamegraph.pl or speedscope
+#       Sampling weights are numbers of samples, and the stage being run is the root frame
+#       cProfile only records callers, not whole stacks, so its stacks are rebuilt from the call graph, weighted in microseconds
+#
+# To print the functions that took the most time in a pstats file:
+#   python profiling.py profiling_output.prof
+
+import collections
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+import metrics
+
+output_file = "profiling_output"
+
+# Seconds between samples of the Sampling profiler
+sample_interval = 0.005
+
+# Deepest stack rebuilt from the cProfile call graph
+max_depth = 64
+
+# Most call paths followed when rebuilding stacks from the cProfile call graph (the number of paths grows exponentially
+# with the depth of a call graph where functions have several callers)
+max_paths = 100000
+
+modes = ("Off", "cProfile", "Sampling")
+
+profiler = None
+
+
+class Profiler:
+    def __init__(self, mode, stages=(), every=1):
+        self.mode = mode
+        self.stages = set(stages)
+        self.every = max(every, 1)
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.images_seen = 0
+        self.images_profiled = 0
+
+        # cProfile: one profile for each thread, since a profile only sees the thread that enabled it; merged when written
+        self.profiles = list()
+
+        # Sampling: thread ident -> thread name of the threads in a profiled region, and the stacks seen so far
+        self.profiling_threads = dict()
+        self.samples = collections.Counter()
+        self.sampler = None
+        self.stopping = threading.Event()
+
+    def begin_image(self, name):
+        with self.lock:
+            self.local.selected = self.images_seen % self.every == 0
+            self.images_seen += 1
+            if self.local.selected:
+                self.images_profiled += 1
+        self.local.depth = 0
+
+        if self.local.selected and len(self.stages) == 0:
+            self.start()
+
+    def end_image(self):
+        if getattr(self.local, "selected", False) and len(self.stages) == 0:
+            self.stop()
+        self.local.selected = False
+
+    def enter_stage(self, name):
+        if getattr(self.local, "selected", False) and name in self.stages:
+            if self.local.depth == 0:
+                self.start()
+            self.local.depth += 1
+
+    def exit_stage(self, name):
+        if getattr(self.local, "selected", False) and name in self.stages:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                self.stop()
+
+    # Start profiling the current thread
+    def start(self):
+        if self.mode == "cProfile":
+            profile = getattr(self.local, "profile", None)
+            if profile is None:
+                profile = self.local.profile = cProfile.Profile()
+                with self.lock:
+                    self.profiles.append(profile)
+            try:
+                profile.enable()
+                self.local.enabled = True
+            except ValueError:
+                # From Python 3.12 only one profile can be enabled at once, and it sees every thread
+                self.local.enabled = False
+            return
+
+        with self.lock:
+            self.profiling_threads[threading.get_ident()] = threading.current_thread().name
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_loop, name="Profiler", daemon=True)
+                self.sampler.start()
+
+    # Stop profiling the current thread
+    def stop(self):
+        if self.mode == "cProfile":
+            if getattr(self.local, "enabled", False):
+                self.local.profile.disable()
+                self.local.enabled = False
+            return
+
+        with self.lock:
+            self.profiling_threads.pop(threading.get_ident(), None)
+
+    def sample_loop(self):
+        while not self.stopping.wait(sample_interval):
+            with self.lock:
+                threads = list(self.profiling_threads.items())
+            if len(threads) == 0:
+                continue
+
+            frames = sys._current_frames()
+            for ident, thread_name in threads:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+
+                stack = list()
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stage = metrics.active_stages.get(thread_name, ("No Stage",))[0]
+                stack.append(stage)
+
+                self.samples[';'.join(reversed(stack))] += 1
+
+    # Stop profiling and write out the results
+    # Returns the paths of the files written
+    def finish(self, path):
+        self.stopping.set()
+        if self.sampler is not None:
+            self.sampler.join()
+
+        written = list()
+        if self.mode == "cProfile":
+            # Threads still profiling can only be stopped by themselves; the driver has finished its images by now
+            stats = None
+            for profile in self.profiles:
+                try:
+                    if stats is None:
+                        stats = pstats.Stats(profile)
+                    else:
+                        stats.add(profile)
+                except TypeError:
+                    # Nothing was profiled on that thread
+                    pass
+            if stats is None:
+                return written
+            stats.sort_stats(pstats.SortKey.TIME)
+            stats.dump_stats(path + ".prof")
+            written.append(path + ".prof")
+            folded = folded_from_stats(stats)
+        else:
+            folded = self.samples
+
+        with open(path + ".folded", 'w') as f:
+            for stack, weight in sorted(folded.items()):
+                f.write("{} {}\n".format(stack, weight))
+        written.append(path + ".folded")
+        return written
+
+
+def frame_name(code):
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(';', ',')
+
+
+def function_name(func):
+    filename, line, name = func
+    return "{} ({}:{})".format(name, os.path.basename(filename), line).replace(';', ',')
+
+
+# Rebuild collapsed stacks from a cProfile call graph
+# Each function's own time is split between its callers in proportion to the time spent in it from each caller,
+# and so on up to functions with no callers (or until the stack would repeat a function)
+# A path stops early, keeping its time on the stack so far, once its share is under a microsecond
+# or after max_paths paths have been followed
+def folded_from_stats(stats):
+    folded = collections.Counter()
+    paths_left = [max_paths]
+
+    def walk(func, stack, share):
+        paths_left[0] -= 1
+        callers = stats.stats[func][4]
+        total = sum([v[3] for v in callers.values()])
+        if len(callers) == 0 or total <= 0 or len(stack) >= max_depth or share * 1e6 < 1 or paths_left[0] <= 0:
+            weight = int(round(share * 1e6))
+            if weight > 0:
+                folded[';'.join([function_name(f) for f in reversed(stack)])] += weight
+            return
+
+        for caller, v in callers.items():
+            if caller in stack or caller not in stats.stats:
+                folded[';'.join([function_name(f) for f in reversed(stack)])] += int(round(share * v[3] / total * 1e6))
+            else:
+                walk(caller, stack + [caller], share * v[3] / total)
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if tt > 0:
+            walk(func, [func], tt)
+
+    return folded
+
+
+# Start profiling as set in the performance settings
+# Does nothing if Profiling is Off
+def start(performance):
+    global profiler
+    mode = performance["Profiling"]
+    if mode not in modes:
+        print("Unknown profiling mode {}, profiling is off".format(mode))
+        return None
+    if mode == "Off":
+        return None
+
+    stages = [s.strip() for s in performance["Profiling Stages"].split(',') if s.strip() != '']
+    for stage in stages:
+        if stage not in metrics.stages:
+            print("Profiling unknown stage {}".format(stage))
+
+    profiler = Profiler(mode, stages, performance["Profile Every"])
+    metrics.observers.append(profiler)
+    return profiler
+
+
+# Stop profiling and write out the results, if profiling was started
+def finish():
+    global profiler
+    if profiler is None:
+        return
+
+    metrics.observers.remove(profiler)
+    start_time = time.perf_counter()
+    written = profiler.finish(output_file)
+    print("Profiled {} of {} images, written to {} ({:.2f} s)".format(profiler.images_profiled, profiler.images_seen,
+                                                                       ", ".join(written), time.perf_counter() - start_time))
+    profiler = None
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python profiling.py <pstats file> [number of functions]")
+        sys.exit(1)
+
+    stats = pstats.Stats(sys.argv[1])
+    stats.sort_stats(pstats.SortKey.TIME)
+    stats.print_stats(int(sys.argv[2]) if len(sys.argv) > 2 else 30)
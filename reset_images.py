@@ -5,6 +5,9 @@ import global_vars
 from global_vars import slash
 import traceback
 import pandas as pd
+import metadata_store
+import thumbnails
+import shutil
 
 def extract_filename(path):
     slash_index = path.rfind(slash)
@@ -63,4 +66,13 @@ if __name__ == "__main__":
     log_file = global_vars.parameters.get('Log File')
     if os.path.isfile(log_file):
         os.remove(log_file)
+
+    for suffix in ('', '-wal', '-shm'):
+        store_file = metadata_store.store_path() + suffix
+        if os.path.isfile(store_file):
+            os.remove(store_file)
+
+    thumbnail_folder = global_vars.parameters["Working Folder"] + slash + thumbnails.folder_name
+    if os.path.isdir(thumbnail_folder):
+        shutil.rmtree(thumbnail_folder)
     
\ No newline at end of file
@@ -0,0 +1,160 @@
+# Headstone Photograph Processing System
+# Result Cache
+# Remembers the results of the expensive stages (rotation, cropping and OCR) for every photo processed,
+# so that re-running a dataset after changing only the labeling settings skips straight to labeling
+#
+# Results are keyed on a hash of the image file's bytes, the settings that affect those stages and the model files
+# The cache is a SQLite file in the Working Folder, holding at most "Result Cache Size" entries (least recently used are evicted)
+#
+# To empty the cache:
+#   python result_cache.py clear
+# To show how many entries it holds:
+#   python result_cache.py stats
+
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from global_vars import global_vars, slash
+
+cache_filename = ".result_cache.sqlite"
+
+# A change to any of these files invalidates every cached result
+model_files = ("macro_model.h5", "micro_model.h5", "model_cropping_new333.pt", "craft_mlt_25k.pth", "craft_refiner_CTW1500.pth")
+
+cache = None
+
+
+class Result_Cache:
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS results (
+                                       key TEXT PRIMARY KEY,
+                                       rotation TEXT,
+                                       crop_box TEXT,
+                                       ocr_text TEXT,
+                                       last_used REAL)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.connection.commit()
+        self.num_entries = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    # Returns a dict of the stored results, or None if there are none for key
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT rotation, crop_box, ocr_text FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+
+            self.connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+
+        rotation, crop_box, ocr_text = [json.loads(x) for x in row]
+        return {
+            "Rotation": tuple(rotation),
+            "Crop Box": None if crop_box is None else tuple(crop_box),
+            "OCR Text": ocr_text
+        }
+
+    def put(self, key, rotation, crop_box, ocr_text):
+        with self.lock:
+            exists = self.connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+            self.connection.execute("REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                                    (key, json.dumps(rotation), json.dumps(crop_box), json.dumps(ocr_text), time.time()))
+            if not exists:
+                self.num_entries += 1
+            self.evict()
+            self.connection.commit()
+
+    # Remove the least recently used entries until the cache fits in max_entries
+    # Must be called with the lock held
+    def evict(self):
+        excess = self.num_entries - self.max_entries
+        if excess <= 0:
+            return
+
+        self.connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (excess,))
+        self.num_entries -= excess
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM results")
+            self.connection.commit()
+            self.num_entries = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        return self.num_entries
+
+
+# Open the cache in the Working Folder
+# Does nothing if it's already open
+def open_cache():
+    global cache
+    if cache is None:
+        path = global_vars.parameters["Working Folder"] + slash + cache_filename
+        cache = Result_Cache(path, global_vars.performance["Result Cache Size"])
+    return cache
+
+
+# Describes the settings and models that produced a result
+def settings_fingerprint():
+    settings = [global_vars.toggles[k] for k in ("Macro Rotate", "Micro Rotate", "Crop", "OCR")]
+    settings += [global_vars.options[k] for k in ("Cropping Buffer", "OCR Technique")]
+    settings += [global_vars.performance["Orientation Prefilter"]]
+
+    for model_file in model_files:
+        try:
+            stat = os.stat(model_file)
+            settings.append((model_file, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            settings.append((model_file, None))
+
+    return json.dumps(settings)
+
+
+# Cache key for a headstone's original image
+# The hash of the image's bytes is kept on the headstone as content_hash
+def get_key(headstone):
+    if headstone.content_hash is None:
+        with open(headstone.original_path, 'rb') as f:
+            headstone.content_hash = hashlib.sha256(f.read()).hexdigest()
+
+    fingerprint = hashlib.sha256(settings_fingerprint().encode()).hexdigest()
+    return headstone.content_hash + '-' + fingerprint
+
+
+# Returns the cached results for headstone, or None if there are none
+def lookup(headstone):
+    return open_cache().get(get_key(headstone))
+
+
+# Cache the rotation, crop box and OCR text of headstone
+def store(headstone):
+    open_cache().put(get_key(headstone), headstone.rotation, headstone.crop_box, headstone.ocr_text)
+
+
+# Remove every cached result
+def invalidate():
+    open_cache().clear()
+
+
+if __name__ == "__main__":
+    global_vars.init_working_folder()
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+
+    if command == "clear":
+        invalidate()
+        print("Result cache cleared")
+    elif command == "stats":
+        print("Result cache entries: {} (max {})".format(len(open_cache()), cache.max_entries))
+    else:
+        print("Usage: python result_cache.py [clear|stats]")
@@ -1,11 +1,76 @@
 import numpy as np
 import cv2, imutils, math, glob
+import threading
+from PIL import Image
 from tensorflow import keras
+import metrics
 
 # Model loading
 macro_model = None
 micro_model = None
 
+
+# Cheap check to skip macro inference on photos that are already upright
+# Photos are grouped by camera, EXIF orientation and aspect ratio; once the macro model has said
+# "upright" enough times in a row for a group, later photos of that group skip the macro model
+# Every Nth skip the model is still run, to detect if the cached verdict has gone wrong
+class Orientation_Prefilter:
+    def __init__(self, trust_after=5, sample_every=20):
+        self.trust_after = trust_after
+        self.sample_every = sample_every
+        self.verdicts = dict()
+        self.counters = {"Checked": 0, "Skipped": 0, "Sampled": 0, "Disagreed": 0}
+        self.lock = threading.Lock()
+
+    # The group a photo belongs to: (camera make, camera model, EXIF orientation, portrait or not)
+    # cv2 has already applied the EXIF orientation, so image is as the camera thinks it should be shown
+    @staticmethod
+    def key(path, image):
+        try:
+            with Image.open(path) as im:
+                exif = im.getexif()
+        except Exception:
+            exif = dict()
+
+        make = exif.get(0x010F, '')
+        model = exif.get(0x0110, '')
+        orientation = exif.get(0x0112, 1)
+        portrait = image.shape[0] >= image.shape[1]
+
+        return make, model, orientation, portrait
+
+    # Returns "Skip" to skip the macro model, "Sample" to run it to verify a skip, or "Run" to run it
+    def decide(self, key):
+        with self.lock:
+            self.counters["Checked"] += 1
+            if self.verdicts.get(key, 0) < self.trust_after:
+                return "Run"
+
+            self.counters["Skipped"] += 1
+            if self.counters["Skipped"] % self.sample_every == 0:
+                return "Sample"
+            return "Skip"
+
+    # Record what the macro model said about a photo of the group key
+    def record(self, key, upright, sampled=False):
+        with self.lock:
+            if sampled:
+                self.counters["Sampled"] += 1
+                if not upright:
+                    self.counters["Disagreed"] += 1
+
+            if upright:
+                self.verdicts[key] = self.verdicts.get(key, 0) + 1
+            else:
+                self.verdicts[key] = 0
+
+    def report(self):
+        with self.lock:
+            return "Orientation pre-check: " + ", ".join(["{} {}".format(k, v) for k, v in self.counters.items()])
+
+
+prefilter = Orientation_Prefilter()
+
 def rotate_image(image, angle):
     """
     Rotates an OpenCV 2 / NumPy image about it's centre by the given angle
@@ -169,54 +234,160 @@ def find_highest_confidence(input_image, angles, image_width = None, image_heigh
     return max(confidence_scores, key = confidence_scores.get) if rotation == -999 else rotation 
 
 
-def rotation_algorithm(input_image, perform_macro, perform_micro): 
-
-    # Model Loading
+# Load whichever models are needed and not loaded yet
+def load_models(perform_macro, perform_micro):
     global macro_model
     global micro_model
 
     if macro_model is None and perform_macro:
-        macro_model = keras.models.load_model('macro_model.h5')
+        with metrics.model_load("Macro Rotation"):
+            macro_model = keras.models.load_model('macro_model.h5')
     
     if micro_model is None and perform_micro:
-        micro_model = keras.models.load_model('micro_model.h5')
+        with metrics.model_load("Micro Rotation"):
+            micro_model = keras.models.load_model('micro_model.h5')
+
+
+# Decide how an image must be rotated
+# The models only see 224x224 inputs, so input_image can be a reduced resolution proxy of the photo
+# Returns (macro_rotation, micro_rotation):
+#   macro_rotation is one of the cv2.ROTATE_* codes, or None if no macro rotation is needed
+#   micro_rotation is an angle in degrees, 0 if no micro rotation is needed
+# prefilter_key: the photo's Orientation_Prefilter.key, to let the pre-check skip macro inference
+def find_rotation(input_image, perform_macro, perform_micro, prefilter_key=None):
+    load_models(perform_macro, perform_micro)
     
     # Rotation angles
     macro_angles = [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE]
     micro_angles = [5, 4, 3, 2, 1, -1, -2, -3, -4, -5]
 
-    # Image dimensions needed for rotation calculation
-    image_height, image_width = input_image.shape[0:2]
+    macro_rotation = None
+    micro_rotation = 0
 
     # Preprocessing of non-rotated original
     temp_image = preprocessing(input_image)
 
-    if perform_macro:
-        # Macro Prediction
-        prediction = np.argmax(macro_model.predict(temp_image))
-        
-        # Macro Rotation of non-rotated original image
-        rotation = 0
-        if prediction != 0:
-            rotation = find_highest_confidence(input_image, macro_angles)
-
-            # Macro rotation
-            input_image = cv2.rotate(input_image, rotation)
+    decision = "Run"
+    if perform_macro and prefilter_key is not None:
+        decision = prefilter.decide(prefilter_key)
+
+    if perform_macro and decision != "Skip":
+        with metrics.stage("Macro Rotate"):
+            # Macro Prediction
+            prediction = np.argmax(macro_model.predict(temp_image))
+
+            if prefilter_key is not None:
+                prefilter.record(prefilter_key, prediction == 0, sampled=decision == "Sample")
             
-            # Preprocessing of macro rotated original
-            temp_image = preprocessing(input_image)
+            # Macro Rotation of non-rotated original image
+            if prediction != 0:
+                macro_rotation = find_highest_confidence(input_image, macro_angles)
+
+                # Macro rotation
+                input_image = cv2.rotate(input_image, macro_rotation)
+                
+                # Preprocessing of macro rotated original
+                temp_image = preprocessing(input_image)
 
     if perform_micro:
-        # Micro Prediction
-        prediction = np.argmax(micro_model.predict(temp_image))
-        
-        # If the image is classifed as rotated, the angle it is rotated at is found and saved
-        rotation = 0
-        if prediction == 1:
-            rotation = find_highest_confidence(input_image, micro_angles, image_width, image_height)
+        with metrics.stage("Micro Rotate"):
+            # Micro Prediction
+            prediction = np.argmax(micro_model.predict(temp_image))
             
-            # Micro rotation
-            input_image = micro_rotate(input_image, rotation, image_width, image_height)
+            # If the image is classifed as rotated, the angle it is rotated at is found and saved
+            if prediction == 1:
+                # Image dimensions needed for rotation calculation
+                image_height, image_width = input_image.shape[0:2]
+                micro_rotation = find_highest_confidence(input_image, micro_angles, image_width, image_height)
     
+    return macro_rotation, micro_rotation
+
+
+# Apply a rotation decided by find_rotation to an image of any resolution
+def apply_rotation(input_image, macro_rotation, micro_rotation):
+    if macro_rotation is not None:
+        with metrics.stage("Macro Rotate"):
+            input_image = cv2.rotate(input_image, macro_rotation)
+
+    if micro_rotation != 0:
+        with metrics.stage("Micro Rotate"):
+            image_height, image_width = input_image.shape[0:2]
+            input_image = micro_rotate(input_image, micro_rotation, image_width, image_height)
+
     return input_image
 
+
+# The affine transform performed by apply_rotation, without applying it
+# Maps pixel coordinates of a width x height image to pixel coordinates of the rotated (and trimmed) image
+# Returns (matrix, new_width, new_height), where matrix is 3x3
+def rotation_matrix(width, height, macro_rotation, micro_rotation):
+    matrix = np.identity(3)
+
+    # Macro rotations only move whole pixels
+    if macro_rotation == cv2.ROTATE_90_CLOCKWISE:
+        matrix = np.array([[0, -1, height - 1], [1, 0, 0], [0, 0, 1]], dtype=float)
+        width, height = height, width
+    elif macro_rotation == cv2.ROTATE_180:
+        matrix = np.array([[-1, 0, width - 1], [0, -1, height - 1], [0, 0, 1]], dtype=float)
+    elif macro_rotation == cv2.ROTATE_90_COUNTERCLOCKWISE:
+        matrix = np.array([[0, 1, 0], [-1, 0, width - 1], [0, 0, 1]], dtype=float)
+        width, height = height, width
+
+    if micro_rotation != 0:
+        # Rotation onto a canvas large enough to hold the entire image (as in imutils.rotate_bound)
+        center = (width / 2, height / 2)
+        rot_mat = np.vstack([cv2.getRotationMatrix2D(center, -micro_rotation, 1.0), [0, 0, 1]])
+        cos = abs(rot_mat[0, 0])
+        sin = abs(rot_mat[0, 1])
+        bound_width = int(height * sin + width * cos)
+        bound_height = int(height * cos + width * sin)
+        rot_mat[0, 2] += bound_width / 2 - center[0]
+        rot_mat[1, 2] += bound_height / 2 - center[1]
+
+        # Followed by trimming the black corners (as in crop_around_center)
+        inner_width, inner_height = largest_rotated_rect(width, height, math.radians(micro_rotation))
+        inner_width = min(inner_width, bound_width)
+        inner_height = min(inner_height, bound_height)
+        center_x = int(bound_width * 0.5)
+        center_y = int(bound_height * 0.5)
+        x1 = int(center_x - inner_width * 0.5)
+        x2 = int(center_x + inner_width * 0.5)
+        y1 = int(center_y - inner_height * 0.5)
+        y2 = int(center_y + inner_height * 0.5)
+
+        trim = np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]], dtype=float)
+        matrix = trim @ rot_mat @ matrix
+        width, height = x2 - x1, y2 - y1
+
+    return matrix, width, height
+
+
+# Rotate an image and cut bounds = (top, bottom, left, right) out of the rotated image, in a single step
+# Gives the same result as apply_rotation followed by slicing, but the rotated full image is never built
+def rotate_and_crop(input_image, macro_rotation, micro_rotation, bounds):
+    image_height, image_width = input_image.shape[0:2]
+    matrix, _, _ = rotation_matrix(image_width, image_height, macro_rotation, micro_rotation)
+    top, bottom, left, right = bounds
+
+    # Without micro rotation, slice the original and only rotate the slice by a multiple of 90 degrees
+    if micro_rotation == 0:
+        corners = np.array([[left, right - 1], [top, bottom - 1], [1, 1]], dtype=float)
+        x, y, _ = np.rint(np.linalg.inv(matrix) @ corners).astype(int)
+        cropped = input_image[min(y):max(y) + 1, min(x):max(x) + 1]
+        if macro_rotation is not None:
+            cropped = cv2.rotate(cropped, macro_rotation)
+        return cropped
+
+    crop = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype=float)
+    matrix = crop @ matrix
+    with metrics.stage("Micro Rotate"):
+        return cv2.warpAffine(input_image, matrix[0:2], (right - left, bottom - top))
+
+
+# proxy: optional reduced resolution copy of input_image to run the models on
+def rotation_algorithm(input_image, perform_macro, perform_micro, proxy=None): 
+    if proxy is None:
+        proxy = input_image
+
+    rotation = find_rotation(proxy, perform_macro, perform_micro)
+    return apply_rotation(input_image, *rotation)
@@ -1,12 +1,16 @@
 from matplotlib import pyplot as plt
 import statistics
+import sys
+import metrics
 
-def show_runtimes_as_hist():
-    with open("runtime_output_file.txt") as f:
-        data = f.read()
+def show_runtimes_as_hist(path="runtime_output_file.jsonl"):
+    records = metrics.load_records(path)
 
-    data = data.split('\n')
-    data = [float(x) for x in data if x != '']
+    # Per-stage breakdown, as printed by the driver at the end of a run
+    print(metrics.format_summary(metrics.summary(records)))
+    print()
+
+    data = [record["Total"] for record in records]
     data.sort()
 
     lo = int(data[0])
@@ -18,7 +22,7 @@ def show_runtimes_as_hist():
 
     info = {
         'Mean': statistics.mean(data),
-        'Stdev': statistics.stdev(data),
+        'Stdev': statistics.stdev(data) if len(data) > 1 else 0.0,
         'Min': lo,
         'Max': hi
     }
@@ -31,4 +35,7 @@ def show_runtimes_as_hist():
 
 
 if __name__ == "__main__":
-    show_runtimes_as_hist()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        show_runtimes_as_hist(sys.argv[1])
+    else:
+        show_runtimes_as_hist()
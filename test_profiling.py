@@ -0,0 +1,57 @@
+# Headstone Photograph Processing System
+# Profiling Tests
+#   python -m unittest test_profiling
+
+import time
+import unittest
+
+import profiling
+
+
+# Stand-in for pstats.Stats, with only the call graph folded_from_stats reads
+class Fake_Stats:
+    def __init__(self, stats):
+        self.stats = stats
+
+
+# Call graph shaped like a chain of diamonds: every function in a layer is called by both functions of the layer above
+# The number of call paths from the bottom to the top doubles with every layer
+def diamond_stats(num_layers, leaf_time=1.0):
+    layers = [[("graph.py", layer * 10 + i, "f{}_{}".format(layer, i)) for i in range(2)] for layer in range(num_layers)]
+    stats = dict()
+    for layer, funcs in enumerate(layers):
+        callers = layers[layer - 1] if layer > 0 else list()
+        tt = leaf_time if layer == num_layers - 1 else 0.0
+        time_in = leaf_time if layer == num_layers - 1 else 2.0 ** (layer - num_layers + 1)
+        for func in funcs:
+            stats[func] = (1, 1, tt, time_in, {caller: (1, 1, 0.0, time_in / len(callers)) for caller in callers})
+    return Fake_Stats(stats)
+
+
+class Folded_From_Stats_Test(unittest.TestCase):
+    def test_diamond_is_bounded(self):
+        stats = diamond_stats(40)
+
+        start = time.perf_counter()
+        folded = profiling.folded_from_stats(stats)
+        elapsed = time.perf_counter() - start
+
+        self.assertLess(elapsed, 10.0)
+        self.assertLessEqual(len(folded), profiling.max_paths)
+
+        # Time isn't lost when paths stop early, only rounded to microseconds
+        self.assertAlmostEqual(sum(folded.values()), 2 * 1e6, delta=len(folded))
+
+    def test_small_graph_is_exact(self):
+        stats = diamond_stats(3)
+        folded = profiling.folded_from_stats(stats)
+
+        # 2 leaves, each reached through 4 paths
+        self.assertEqual(len(folded), 8)
+        self.assertEqual(set(folded.values()), {250000})
+        for stack in folded:
+            self.assertEqual(len(stack.split(';')), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import warnings
+import metrics
 
 from craft_text_detector import (
     read_image,
@@ -30,14 +31,16 @@ def OCR(image):
     global refine_net
 
     if craft_net is None:
-        craft_net = CRAFT()
-        craft_net.load_state_dict(copyStateDict(torch.load('craft_mlt_25k.pth', map_location='cpu')))
-        craft_net.eval()
+        with metrics.model_load("Text Detection"):
+            craft_net = CRAFT()
+            craft_net.load_state_dict(copyStateDict(torch.load('craft_mlt_25k.pth', map_location='cpu')))
+            craft_net.eval()
     
     if refine_net is None:
-        refine_net = RefineNet()
-        refine_net.load_state_dict(copyStateDict(torch.load('craft_refiner_CTW1500.pth', map_location='cpu')))
-        refine_net.eval()
+        with metrics.model_load("Text Refinement"):
+            refine_net = RefineNet()
+            refine_net.load_state_dict(copyStateDict(torch.load('craft_refiner_CTW1500.pth', map_location='cpu')))
+            refine_net.eval()
 
     # read the image
     image = read_image(image)
@@ -63,6 +66,8 @@ def OCR(image):
         rectify=True
     )
 
+    return len(exported_file_paths)
+
 from collections import OrderedDict
 def copyStateDict(state_dict):
     if list(state_dict.keys())[0].startswith("module"):
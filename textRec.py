@@ -7,6 +7,7 @@ import os.path
 from os import path
 import matplotlib.pyplot as plt
 from skimage import feature
+import metrics
 
 #Takes each text segment and runs Tesseract character extraction
 def Rec():
@@ -41,6 +42,7 @@ def Rec():
 
         #Tesseract Image to string
         text = pytesseract.image_to_string(thr, lang='eng', config='--psm 13 --oem 3 -c tessedit_char_whitelist="ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 -."')
+        metrics.count("Tesseract Calls")
 
         text = text.split('\n', 1)[0]
         output += [text]
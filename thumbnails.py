@@ -0,0 +1,185 @@
+# Headstone Photograph Processing System
+# Thumbnail Cache
+# Small previews of the original and processed images shown on the Feedback_Screen
+#
+# Thumbnails are made when an image enters the feedback queue (while its images are still in memory),
+# saved in the Working Folder (.thumbnails) and kept in memory for the most recently used images
+# The next few images in the queue are prefetched in a background thread, so moving through the queue never decodes full images
+
+import collections
+import os
+import queue
+import threading
+import traceback
+
+import cv2
+
+from global_vars import global_vars, slash
+
+folder_name = ".thumbnails"
+
+thumbnail_height = 400
+
+# Most thumbnails kept in memory and on disk
+max_memory = 32
+max_disk = 5000
+
+# Images after the one being reviewed to have ready
+prefetch_count = 3
+
+kinds = ("Original", "Modified")
+
+cache = None
+
+# Held while the cache is opened, so there is only ever one (one prefetch thread, one set of thumbnails being made)
+open_lock = threading.Lock()
+
+
+class Thumbnail_Cache:
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        self.num_disk = len(self.list_disk())
+
+        self.lock = threading.Lock()
+        self.memory = collections.OrderedDict()
+
+        # Key -> event set when the thumbnail being made for it is ready, so it's never made twice at once
+        self.in_flight = dict()
+
+        self.requests = queue.Queue()
+        self.prefetcher = threading.Thread(target=self.prefetch_loop, name="Thumbnail Prefetch", daemon=True)
+        self.prefetcher.start()
+
+    def get_path(self, id, kind):
+        return self.folder + slash + id + "." + kind.lower() + ".jpg"
+
+    # Thumbnails on disk, without the ones still being written
+    def list_disk(self):
+        return [name for name in os.listdir(self.folder) if not name.startswith(".")]
+
+    # Returns the thumbnail of the kind ("Original" or "Modified") image of headstone
+    # Made from the full image if it isn't cached; if another thread is already making it, waits for that one instead
+    def get(self, headstone, kind):
+        key = (headstone.image_id, kind)
+        thumbnail = self.get_cached(key)
+        if thumbnail is not None:
+            return thumbnail
+
+        with self.lock:
+            ready = self.in_flight.get(key)
+            making = ready is None
+            if making:
+                ready = self.in_flight[key] = threading.Event()
+
+        if not making:
+            ready.wait()
+            thumbnail = self.get_cached(key)
+            if thumbnail is not None:
+                return thumbnail
+
+        try:
+            image = headstone.original_image if kind == "Original" else headstone.modified_image
+            return self.put(key, image)
+        finally:
+            if making:
+                with self.lock:
+                    self.in_flight.pop(key, None)
+                ready.set()
+
+    # Returns the cached thumbnail for key, or None if there isn't one
+    def get_cached(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+
+        path = self.get_path(*key)
+        if not os.path.isfile(path):
+            return None
+
+        thumbnail = cv2.imread(path)
+        if thumbnail is not None:
+            self.remember(key, thumbnail)
+        return thumbnail
+
+    # Make and cache the thumbnail of image for key, and return it
+    def put(self, key, image):
+        scale = thumbnail_height / image.shape[0]
+        dim = (int(image.shape[1] * scale), thumbnail_height)
+        thumbnail = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
+
+        self.remember(key, thumbnail)
+
+        # Written to a temporary file and renamed into place, so a half written thumbnail is never read
+        path = self.get_path(*key)
+        temp_path = self.folder + slash + ".{}.{}.{}.jpg".format(key[0], key[1].lower(), threading.get_ident())
+        is_new = not os.path.isfile(path)
+        if not cv2.imwrite(temp_path, thumbnail):
+            raise Exception("could not write thumbnail " + path)
+        os.replace(temp_path, path)
+        if is_new:
+            with self.lock:
+                self.num_disk += 1
+                evict = self.num_disk > max_disk
+            if evict:
+                self.evict_disk()
+
+        return thumbnail
+
+    def remember(self, key, thumbnail):
+        with self.lock:
+            self.memory[key] = thumbnail
+            self.memory.move_to_end(key)
+            while len(self.memory) > max_memory:
+                self.memory.popitem(last=False)
+
+    # Remove the least recently written tenth of the thumbnails on disk
+    def evict_disk(self):
+        paths = [self.folder + slash + name for name in self.list_disk()]
+        paths.sort(key=lambda path: os.path.getmtime(path))
+        removed = 0
+        for path in paths[:max(len(paths) - max_disk * 9 // 10, 0)]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        with self.lock:
+            self.num_disk = len(paths) - removed
+
+    # Make the thumbnails of a headstone entering the feedback queue, while its images are in memory
+    # The original's thumbnail is made from the proxy, which is already small
+    def add(self, headstone):
+        self.put((headstone.image_id, "Original"), headstone.proxy_image)
+        self.put((headstone.image_id, "Modified"), headstone.modified_image)
+
+    # Have the thumbnails of the images at paths ready in memory
+    def prefetch(self, paths):
+        for path in paths:
+            self.requests.put(path)
+
+    def prefetch_loop(self):
+        from headstone import Headstone
+
+        while True:
+            path = self.requests.get()
+            if not os.path.isfile(path):
+                continue
+            try:
+                headstone = Headstone.load(path)
+                for kind in kinds:
+                    self.get(headstone, kind)
+            except Exception:
+                traceback.print_exc()
+
+
+# Open the cache in the Working Folder
+# Does nothing if it's already open
+def open_cache():
+    global cache
+    with open_lock:
+        if cache is None:
+            cache = Thumbnail_Cache(global_vars.parameters["Working Folder"] + slash + folder_name)
+        return cache
@@ -0,0 +1,202 @@
+# Headstone Photograph Processing System
+# Folder Watcher
+# Streams the photos added to the Image Folder while the system runs, so they're processed without starting it again
+#
+# Set in the settings file:
+#   > Watch Folder (True or False): After the photos already in the Image Folder, keep processing new ones until aborted
+#   > Watch Stable Seconds: How long a new photo's size and modification time must stay unchanged before it's processed
+#
+# On Linux the folder is watched with inotify (a photo finished writing or moved in); elsewhere, or if inotify
+# can't be used, the folder is scanned every poll_interval seconds
+# Either way a photo is only handed out once it's stable, so one still being uploaded is never read half written
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import queue
+import select
+import struct
+import threading
+import time
+import traceback
+
+import metrics
+from global_vars import global_vars, slash
+
+# Photos picked up, as driver.load_images finds them
+pattern = "*.JPG"
+
+# Seconds between scans of the folder when polling, and between stability checks
+poll_interval = 1.0
+check_interval = 0.25
+
+# inotify constants (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+event_header = struct.Struct("iIII")
+
+
+class Folder_Watcher:
+    def __init__(self, folder, known=(), stable_seconds=2.0):
+        self.folder = folder
+        self.stable_seconds = stable_seconds
+
+        # Paths already handed out (or about to be), so they aren't picked up again
+        self.seen = set(known)
+
+        # Path -> (size, modification time, time they were first seen unchanged), for new photos not yet stable
+        self.candidates = dict()
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()
+
+        self.inotify_fd = open_inotify(folder)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.watch_loop, name="Folder Watcher", daemon=True)
+        self.thread.start()
+
+    def matches(self, name):
+        return not name.startswith(".") and fnmatch.fnmatchcase(name, pattern)
+
+    def add_candidate(self, path):
+        with self.lock:
+            if path not in self.candidates:
+                self.candidates[path] = None
+
+    # Find new photos by listing the folder
+    # Photos no longer in the folder are forgotten, so one uploaded again under the same name is picked up
+    def scan(self):
+        try:
+            names = [name for name in os.listdir(self.folder) if self.matches(name)]
+        except OSError:
+            return
+
+        paths = {self.folder + slash + name for name in names}
+        with self.lock:
+            self.seen &= paths | set(self.candidates)
+        for path in paths:
+            if path not in self.seen:
+                self.add_candidate(path)
+
+    def read_events(self, timeout):
+        readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if len(readable) == 0:
+            return
+
+        try:
+            data = os.read(self.inotify_fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + event_header.size <= len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            name = data[offset + event_header.size:offset + event_header.size + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += event_header.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                self.scan()
+            elif self.matches(name):
+                # A photo written again after it was handed out is new content
+                path = self.folder + slash + name
+                with self.lock:
+                    self.seen.discard(path)
+                self.add_candidate(path)
+
+    # Hand out the candidates whose size and modification time haven't changed for stable_seconds
+    def check_candidates(self):
+        now = time.monotonic()
+        with self.lock:
+            candidates = list(self.candidates.items())
+
+        for path, last in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                with self.lock:
+                    self.candidates.pop(path, None)
+                continue
+
+            state = (stat.st_size, stat.st_mtime_ns)
+            if last is None or last[:2] != state:
+                with self.lock:
+                    self.candidates[path] = state + (now,)
+            elif stat.st_size > 0 and now - last[2] >= self.stable_seconds:
+                with self.lock:
+                    self.candidates.pop(path, None)
+                    self.seen.add(path)
+                self.ready.put(path)
+
+    def watch_loop(self):
+        # Photos added between loading the folder and starting to watch it
+        self.scan()
+        last_scan = time.monotonic()
+
+        while not self.stopping.is_set():
+            try:
+                if self.inotify_fd is None:
+                    self.stopping.wait(check_interval)
+                    if time.monotonic() - last_scan >= poll_interval:
+                        self.scan()
+                        last_scan = time.monotonic()
+                else:
+                    self.read_events(check_interval)
+                self.check_candidates()
+            except Exception:
+                traceback.print_exc()
+                self.stopping.wait(poll_interval)
+
+    # Returns the next stable photo, or None if there isn't one within timeout seconds
+    def get(self, timeout):
+        try:
+            return self.ready.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    # Photos found that haven't been handed out yet
+    def num_waiting(self):
+        with self.lock:
+            return self.ready.qsize() + len(self.candidates)
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+# Returns a non-blocking inotify file descriptor watching folder, or None if inotify isn't available
+def open_inotify(folder):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None
+    if fd < 0:
+        return None
+
+    if libc.inotify_add_watch(fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+# Yields paths, then every photo added to the Image Folder as it becomes stable, until is_aborting() is True
+# The folder is watched from the start, so photos added while paths are processed aren't missed
+def stream(paths, is_aborting):
+    folder_watcher = Folder_Watcher(global_vars.parameters["Image Folder"], paths, global_vars.performance["Watch Stable Seconds"])
+    metrics.register_gauge("Watch", folder_watcher.num_waiting)
+    try:
+        yield from paths
+
+        while not is_aborting():
+            path = folder_watcher.get(check_interval)
+            if path is not None:
+                global_vars.num_images += 1
+                yield path
+    finally:
+        folder_watcher.close()